@@ -1,5 +1,5 @@
-import glob, json, nltk, os, pickle, re
-from collections import deque
+import array, glob, hashlib, json, multiprocessing, nltk, os, pickle, struct, sys, time
+from collections import defaultdict, deque, OrderedDict
 from vnet_constants import DATA_DIR
 
 class DerivationTree(nltk.Tree):
@@ -7,77 +7,226 @@ class DerivationTree(nltk.Tree):
     Class representing a tree (either initial or auxiliary) in the XTAG grammar
     Label specified as "prefix_suffix-renamesuffix", i.e. "NP_0-1"
     """
-    def __init__(self, label, children=None, filename=None):
+    CACHE_VERSION = 1 # Of the load_all cache, bumped when from_dict changes
+
+    def __init__(self, label, children=None, filename=None, token_pos=None, file_ids=None):
         if children is None:
             children = []
+        if file_ids is None:
+            file_ids = DerivationTree.filename_to_file_sent_num(filename)
         self._label = label
         self.tree_name, self.anchor, self.location = DerivationTree.label_to_tree_word_loc(label)
-        self.file_num, self.sentence_num = DerivationTree.filename_to_file_sent_num(filename)
+        self.file_num, self.sentence_num = file_ids
         self.filename = filename
+        self.token_pos = token_pos # Position of anchor in sentence tokens, if known
         nltk.Tree.__init__(self, self._label, children)
 
+    def assign_token_positions(self, tokens, grammar):
+        """
+        Returns self after setting token_pos on every node whose anchor can be
+        found in tokens (the words of the sentence). A word that occurs several
+        times is given its positions in the order its anchors appear in the
+        sentence (see surface_order)
+        """
+        positions = defaultdict(deque)
+        for i, token in enumerate(tokens):
+            positions[token].append(i)
+
+        for s in self.surface_order(grammar):
+            if len(positions[s.anchor]) > 0:
+                s.token_pos = positions[s.anchor].popleft()
+        return self
+
+    def align_tokens(self, grammar):
+        """
+        Returns self after assigning the token positions of a derivation read
+        with its sentence (see from_dict), the first time only
+        """
+        # getattr b/c pickled derivations from before tokens were kept don't have them
+        if getattr(self, 'tokens', None) is not None and not getattr(self, 'tokens_aligned', False):
+            self.assign_token_positions(self.tokens, grammar)
+            self.tokens_aligned = True
+        return self
+
+    def surface_order(self, grammar):
+        """
+        Returns the nodes of self in the order their anchors appear in the
+        sentence. The order is worked out from the elementary trees, which are
+        looked at in place (without copying): a substituted tree takes the
+        place of its substitution node, and an adjoined tree wraps the subtree
+        it adjoins at, on either side of its foot. Children whose location
+        isn't in their parent's tree come after it
+        """
+        # Pre-order with a stack, reversed so children come before parents
+        nodes = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node)
+
+        # {id(node): [nodes in surface order]}, with None at the foot of an auxiliary tree
+        yields = {}
+        for node in reversed(nodes):
+            tree = grammar.get(node.tree_name, copy=False)
+            substituted, adjoined = defaultdict(list), defaultdict(list)
+            for c in node:
+                if 'beta' in c.tree_name:
+                    adjoined[c.location].append(c)
+                else:
+                    substituted[c.location].append(c)
+
+            if tree is None:
+                items = [node]
+            else:
+                items = DerivationTree.elementary_yield(tree, [node], substituted, adjoined, yields)
+            # Attachments that didn't find their location
+            for c in [c for cs in list(substituted.values()) + list(adjoined.values()) for c in cs]:
+                items += [n for n in yields[id(c)] if n is not None]
+            yields[id(node)] = items
+        return [n for n in yields[id(self)] if n is not None]
+
+    @classmethod
+    def elementary_yield(cls, tree_node, anchors, substituted, adjoined, yields):
+        """
+        Returns the surface order of the subtree of an elementary tree at
+        tree_node, with the children attached to it (see surface_order).
+        anchors holds the derivation node, which is placed at the first
+        anchor position. Attached children are removed from substituted and
+        adjoined as they're placed
+        """
+        items = []
+        if tree_node.foot:
+            items.append(None) # Where the adjoined-at subtree goes
+        elif tree_node.anchor and len(anchors) > 0:
+            items.append(anchors.pop())
+        elif tree_node.subst:
+            for c in substituted.pop(tree_node.original_label(), []):
+                items += yields[id(c)]
+        for child in tree_node:
+            if isinstance(child, nltk.Tree):
+                items += cls.elementary_yield(child, anchors, substituted, adjoined, yields)
+
+        for c in adjoined.pop(tree_node.original_label(), []):
+            aux = yields[id(c)]
+            foot = aux.index(None) if None in aux else len(aux)
+            items = aux[:foot] + items + aux[foot + 1:]
+        return items
+
+    def argument_alignment(self, propbank):
+        """
+        Returns the ArgumentAlignment of this sentence's Propbank arguments to
+        nodes of self, computing it the first time only
+        """
+        # getattr b/c pickled derivations from before alignments don't have it
+        if getattr(self, 'alignment', None) is None:
+            instances = propbank.get_instances(self.file_num, self.sentence_num)
+            self.alignment = ArgumentAlignment(self, instances)
+        return self.alignment
+
+    def pb_instance(self, semgrammar):
+        """Returns this node's Propbank instance if it's a verb tree, else None"""
+        tree = semgrammar.grammar.get(self.tree_name, copy=False)
+        if tree is None or not tree.belongs_to_verb_family():
+            return None
+        return semgrammar.propbank.get_instance(self.file_num, self.sentence_num, self.anchor, token_pos=self.token_pos)
+
+    def frame_choice(self, semgrammar, alignment):
+        """
+        Returns what picks the VerbNet frame of this node, if it's a verb tree
+        with a Propbank instance: the roleset, and the arguments of the
+        instance filled by its children (see alignment, the root's
+        argument_alignment, and SemTreeGrammar.get_semtree). Else None
+        """
+        pb_instance = self.pb_instance(semgrammar)
+        if pb_instance is None:
+            return None
+        return pb_instance.roleset_id, alignment.child_arguments(self, pb_instance)
+
+    def canonical_string(self, semgrammar):
+        """
+        Returns a string that is the same for two derivations exactly when
+        they compose to the same semantics: every node's tree name, anchor,
+        location, frame choice and number of children, in pre-order. File
+        and sentence ids are left out, so repeated sentences share it
+        """
+        self.align_tokens(semgrammar.grammar)
+        alignment = self.argument_alignment(semgrammar.propbank)
+        nodes = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append([node.tree_name, node.anchor, node.location, node.frame_choice(semgrammar, alignment), len(node)])
+            stack.extend(reversed(node))
+        return json.dumps(nodes)
+
     def have_semantics(self, grammar, tree_families, tree_set):
         """Returns True if every elem tree in self is in tree_set (annotated)"""
-        trees = [grammar.get(s.tree_name) for s in self.subtrees()]
-        return all(t is not None and (t.tree_family in tree_families or t.tree_name in tree_set) for t in trees)
+        return all(DerivationTree.tree_has_semantics(grammar, s.tree_name, tree_families, tree_set) for s in self.subtrees())
 
-    def get_parse_tree(self, semgrammar, depth=0):
-        if semgrammar.grammar.get(self.tree_name, copy=False).belongs_to_verb_family():
-            pb_instance = semgrammar.propbank.get_instance(self.file_num, self.sentence_num, self.anchor)
-        else:
-            pb_instance = None
+    @classmethod
+    def tree_has_semantics(cls, grammar, tree_name, tree_families, tree_set):
+        """Returns True if the elem tree is annotated: its family is in tree_families or it's in tree_set"""
+        tree = grammar.get(tree_name, copy=False)
+        return tree is not None and (tree.tree_family in tree_families or tree_name in tree_set)
+
+    def get_parse_tree(self, semgrammar, depth=0, policy=None, memo=None, stats=None):
+        """
+        Returns the SemTree composed from this derivation (see
+        DerivationComposer). Children that fail to attach are handled by
+        policy, by default SkipFailedAttachments. Composed subtrees are
+        reused from memo, by default the semgrammar's composition_memo.
+        Failures and timings are recorded in stats (an Instrumentation) if
+        given, in which case the memo isn't used (see DerivationComposer)
+        """
+        return DerivationComposer(semgrammar, policy=policy, memo=memo, stats=stats).compose(self, depth)
 
-        semtree = semgrammar.get_semtree(self.tree_name, self.anchor, pb_instance=pb_instance)
+    @classmethod
+    def attachment_sites(cls, semtree, depth):
+        """
+        Returns {(original label, deriv depth): [nodes]} for a freshly built
+        elementary semtree, setting the deriv_depth of its nodes on the way.
+        Attaching children neither removes these nodes nor changes their
+        labels, so the index stays valid while the children are attached
+        """
+        sites = defaultdict(list)
         for s in semtree.subtrees():
             s.deriv_depth = depth
-
-        for c in self:
-            try:
-                c_semtree = c.get_parse_tree(semgrammar, depth + 1)
-
-                if 'alpha' in c.tree_name:
-                    sub_nodes = [s for s in semtree.subst_nodes() if s.original_label() == c.location and s.deriv_depth == depth]
-                    assert len(sub_nodes) == 1
-                    sub_node = sub_nodes[0]
-                    semtree.substitute(c_semtree, sub_node.label())
-                elif 'beta' in c.tree_name:
-                    adj_nodes = [s for s in semtree.subtrees() if s.original_label() == c.location and s.deriv_depth == depth]
-                    assert len(adj_nodes) == 1
-                    adj_node = adj_nodes[0]
-                    semtree.adjoin(c_semtree, adj_node.label())
-
-            except IndexError:
-                #print("CANNOT FIND TREES ERROR")
-                continue
-            except NotImplementedError:
-                #print("NOT IMPLEMENTED HELPER TREE ERROR")
-                continue
-            except KeyError:
-                #print("KEY ERROR FOR FINDING ROLE")
-                continue
-            except AttributeError:
-                #print("ATTRIBUTE ERROR IN PERFORMING ADJUNCTION")
-                continue
-
-        return semtree
+            sites[(s.original_label(), depth)].append(s)
+        return sites
 
     @classmethod
-    def convert(cls, val, filename=None):
-        """Returns an nltk.Tree converted to a DerivationTree"""
+    def convert(cls, val, filename=None, file_ids=None):
+        """
+        Returns an nltk.Tree converted to a DerivationTree. The (file_num,
+        sent_num) of filename are worked out once and shared by every node
+        """
+        if file_ids is None:
+            file_ids = cls.filename_to_file_sent_num(filename)
         if isinstance(val, nltk.Tree):
-            children = [cls.convert(child, filename=filename) for child in val]
-            return cls(val._label, children=children, filename=filename)
+            children = [cls.convert(child, filename=filename, file_ids=file_ids) for child in val]
+            return cls(val._label, children=children, filename=filename, file_ids=file_ids)
         elif isinstance(val, str):
-            return cls(val, filename=filename)
+            return cls(val, filename=filename, file_ids=file_ids)
 
     @classmethod
     def from_file(cls, filename):
         tree_dict = json.load(open(filename, 'r'))
+        return cls.from_dict(tree_dict, filename)
+
+    @classmethod
+    def from_dict(cls, tree_dict, filename=None):
+        """Returns the DerivationTree of a loaded parse file, None if it has none"""
         if 'deriv' not in tree_dict or tree_dict['deriv'] == 'None':
             return None
         deriv_tree_str = tree_dict['deriv']
         deriv_tree = nltk.Tree.fromstring(deriv_tree_str)
         deriv_tree = DerivationTree.convert(deriv_tree, filename=filename)
+
+        # Anchor positions are only known if the parse file has the sentence,
+        # and are assigned once the grammar is at hand (see align_tokens)
+        if tree_dict.get('sentence') is not None:
+            deriv_tree.tokens = tree_dict['sentence'].split()
         return deriv_tree
 
     @classmethod
@@ -85,12 +234,20 @@ class DerivationTree(nltk.Tree):
         """
         Takes a deriv tree label and returns its components:
             tree_name[anchor]<action_location>, e.g. alphaNXN[chairman]<NP_1>
+        The label is split on its outermost delimiters only, so anchors may
+        themselves contain brackets, i.e. alphaNXN[[]<NP_0> has anchor "["
         """
-        tree_name = re.search('(.*)\[', label).group(1)
-        word = re.search('\[(.*?)\]', label).group(1)
-        loc_match = re.search('\<(.*?)\>', label)
-        loc = loc_match.group(1) if loc_match is not None else None
-        return tree_name, word, loc
+        start = label.index('[')
+        end = len(label)
+        loc = None
+        if label[-1] == '>':
+            loc_start = label.rfind('<')
+            if loc_start > start and label[loc_start - 1] == ']':
+                loc = label[loc_start + 1:-1]
+                end = loc_start
+        if label[end - 1] != ']':
+            raise ValueError("Malformed derivation label: %s" % label)
+        return label[:start], label[start + 1:end - 1], loc
 
     @classmethod
     def prune_deriv_tree(cls, grammar, deriv_tree, tree_families, tree_set):
@@ -107,7 +264,7 @@ class DerivationTree(nltk.Tree):
         while len(queue) > 0:
             t, parent = queue.popleft()
 
-            if grammar.get_tree_family(t.tree_name) not in tree_families and t.tree_name not in tree_set:
+            if not cls.tree_has_semantics(grammar, t.tree_name, tree_families, tree_set):
                 if parent is None:
                     return None
                 else:
@@ -129,12 +286,574 @@ class DerivationTree(nltk.Tree):
             return file_num, sent_num
 
     @classmethod
-    def load_all(cls, treedir=DATA_DIR + 'parse_trees'):
-        pickle_filename = DATA_DIR + 'derivation.pickle'
+    def tree_filenames(cls, treedir=DATA_DIR + 'parse_trees', sections=None):
+        """
+        Returns the parse files in treedir ordered by (file_num, sent_num). If
+        sections (i.e. {"00", "23"}) are given, only files of those WSJ
+        sections are returned
+        """
+        filenames = []
+        for filename in glob.glob(treedir + '/*'):
+            file_num, sent_num = DerivationTree.filename_to_file_sent_num(filename)
+            if sections is None or file_num[:2] in sections:
+                filenames.append((file_num, int(sent_num), filename))
+        return [filename for file_num, sent_num, filename in sorted(filenames)]
+
+    @classmethod
+    def stream(cls, treedir=DATA_DIR + 'parse_trees', sections=None, processes=None, chunksize=64):
+        """
+        Yields the DerivationTrees in treedir one at a time, in tree_filenames
+        order, without holding the corpus in memory. Files are read over a
+        pool of processes (all cores by default, processes=1 reads in this
+        process). Files without a derivation are skipped
+        """
+        filenames = cls.tree_filenames(treedir, sections)
+        if processes == 1:
+            deriv_trees = (cls.from_file(f) for f in filenames)
+            for deriv_tree in deriv_trees:
+                if deriv_tree is not None:
+                    yield deriv_tree
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                # imap keeps input order, unlike imap_unordered
+                for deriv_tree in pool.imap(cls.from_file, filenames, chunksize):
+                    if deriv_tree is not None:
+                        yield deriv_tree
+
+    @classmethod
+    def load_all(cls, treedir=DATA_DIR + 'parse_trees', pickle_filename=DATA_DIR + 'derivation.pickle', processes=None):
+        """
+        Returns every DerivationTree in treedir, in tree_filenames order. The
+        cache keeps a manifest of the size, mtime and hash of each parse
+        file, so only files that were added or changed since the last call
+        are read again (in parallel, see stream) and deleted files are
+        dropped. A file whose mtime changed but whose contents hash the same
+        is kept as is
+        """
+        cache = {}
         if os.path.exists(pickle_filename):
-            return pickle.load(open(pickle_filename, 'rb'))
+            cache = pickle.load(open(pickle_filename, 'rb'))
+        # Caches from before the manifest were plain lists, and are rebuilt,
+        # as are ones whose trees were read by an older from_dict
+        if not isinstance(cache, dict) or cache.get("treedir") != treedir or cache.get("version") != cls.CACHE_VERSION:
+            cache = {"treedir": treedir, "version": cls.CACHE_VERSION, "manifest": {}, "trees": {}}
+        manifest, trees = cache["manifest"], cache["trees"]
+
+        filenames = cls.tree_filenames(treedir)
+        basenames = set(os.path.basename(f) for f in filenames)
+        changed = [name for name in manifest if name not in basenames]
+        for name in changed:
+            del manifest[name]
+            del trees[name]
+
+        to_read = []
+        for filename in filenames:
+            name = os.path.basename(filename)
+            stat = os.stat(filename)
+            record = manifest.get(name)
+            if record is not None and record["size"] == stat.st_size:
+                if record["mtime"] == stat.st_mtime:
+                    continue
+                if record["hash"] == cls.file_hash(filename):
+                    record["mtime"] = stat.st_mtime
+                    changed.append(name)
+                    continue
+            to_read.append(filename)
+
+        if processes == 1 or len(to_read) <= 1:
+            results = [cls.read_tree_file(f) for f in to_read]
         else:
-            deriv_trees = [DerivationTree.from_file(f) for f in glob.glob(treedir + '/*')]
-            deriv_trees = [d for d in deriv_trees if d is not None]
-            pickle.dump(deriv_trees, open(pickle_filename, 'wb'))
-            return deriv_trees
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(cls.read_tree_file, to_read, 64)
+        for filename, (record, deriv_tree) in zip(to_read, results):
+            name = os.path.basename(filename)
+            manifest[name] = record
+            trees[name] = deriv_tree
+            changed.append(name)
+
+        if len(changed) > 0 or not os.path.exists(pickle_filename):
+            pickle.dump(cache, open(pickle_filename, 'wb'))
+
+        deriv_trees = [trees[os.path.basename(f)] for f in filenames]
+        return [d for d in deriv_trees if d is not None]
+
+    @classmethod
+    def read_tree_file(cls, filename):
+        """Returns ({"size", "mtime", "hash"}, DerivationTree or None) for a parse file"""
+        stat = os.stat(filename)
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        record = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": hashlib.sha1(contents).hexdigest()}
+        return record, cls.from_dict(json.loads(contents.decode('utf-8')), filename)
+
+    @classmethod
+    def file_hash(cls, filename):
+        """Returns the sha1 hex digest of the contents of filename"""
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+class SkipFailedAttachments(object):
+    """
+    Failure policy that drops a child (and everything below it) from the
+    composed tree when building or attaching it fails with one of
+    SKIPPED_ERRORS. Failures are counted by error type
+    """
+    # IndexError: cannot find trees, NotImplementedError: helper tree without
+    # semantics, KeyError: finding role, AttributeError: performing adjunction
+    SKIPPED_ERRORS = (IndexError, NotImplementedError, KeyError, AttributeError)
+
+    def __init__(self):
+        self.failures = defaultdict(int) # {KeyError: 3}
+
+    def handle(self, error, deriv_node, parent):
+        """Returns normally to skip deriv_node, or raises error to stop composing"""
+        if not isinstance(error, self.SKIPPED_ERRORS):
+            raise error
+        self.failures[type(error)] += 1
+
+class StrictAttachments(object):
+    """Failure policy that stops composing at the first failed child"""
+
+    def handle(self, error, deriv_node, parent):
+        raise error
+
+class DerivationComposer(object):
+    """
+    Composes the SemTree of a derivation tree bottom-up without recursion:
+    an explicit stack is walked in post-order, so each child is fully
+    composed before it's substituted/adjoined into its parent, exactly like
+    a recursive walk would, but any depth of derivation works. Errors
+    raised while building or attaching a child are given to a failure
+    policy, which decides whether to skip that child or stop. With stats,
+    no memo is used: a memoized subtree would hide the failures and
+    timings of composing it
+    """
+
+    def __init__(self, semgrammar, policy=None, memo=None, stats=None):
+        if policy is None:
+            policy = SkipFailedAttachments()
+        if stats is not None:
+            memo = None
+        elif memo is None:
+            # getattr b/c pickled grammars from before the memo don't have one
+            memo = getattr(semgrammar, 'composition_memo', None)
+        self.semgrammar = semgrammar
+        self.policy = policy
+        self.memo = memo
+        self.stats = stats # Instrumentation, or None for no overhead
+        self.alignment = None # ArgumentAlignment of the sentence being composed
+
+    def compose(self, deriv_tree, depth=0):
+        """
+        Returns the SemTree of deriv_tree. Errors building the root's own
+        elementary tree always propagate, as there is nothing to skip to
+        """
+        deriv_tree.align_tokens(self.semgrammar.grammar)
+        self.alignment = deriv_tree.argument_alignment(self.semgrammar.propbank)
+        if self.stats is None:
+            return self.compose_tree(deriv_tree, depth)
+
+        self.stats.start_sentence(deriv_tree)
+        try:
+            semtree = self.compose_tree(deriv_tree, depth)
+        except Exception as e:
+            self.stats.end_sentence(error=e)
+            raise
+        self.stats.end_sentence()
+        return semtree
+
+    def compose_tree(self, deriv_tree, depth):
+        keys = self.memo.subtree_keys(deriv_tree, self.semgrammar, self.policy) if self.memo is not None else None
+
+        # Stack frames: [deriv node, depth, semtree, attachment sites, next child index]
+        try:
+            stack = [self.start(deriv_tree, depth)]
+        except Exception as e:
+            if self.stats is not None:
+                self.stats.failure(e, deriv_tree)
+            raise
+
+        while True:
+            frame = stack[-1]
+            node, node_depth = frame[0], frame[1]
+            if frame[4] < len(node):
+                child = node[frame[4]]
+                frame[4] += 1
+                memoized = self.memo.get(keys[id(child)]) if keys is not None else None
+                try:
+                    if memoized is not None:
+                        self.attach(frame, child, memoized)
+                    else:
+                        stack.append(self.start(child, node_depth + 1))
+                except Exception as e:
+                    if self.stats is not None:
+                        self.stats.failure(e, child)
+                    self.policy.handle(e, child, node)
+                continue
+
+            stack.pop()
+            if len(stack) == 0:
+                return frame[2]
+            if keys is not None:
+                self.memo.add(keys[id(node)], frame[2])
+            parent = stack[-1]
+            try:
+                self.attach(parent, node, frame[2])
+            except Exception as e:
+                if self.stats is not None:
+                    self.stats.failure(e, node)
+                self.policy.handle(e, node, parent[0])
+
+    def start(self, deriv_node, depth):
+        """Returns the stack frame of deriv_node, after building its elementary semtree"""
+        semgrammar = self.semgrammar
+        pb_instance = deriv_node.pb_instance(semgrammar)
+        arguments = self.alignment.child_arguments(deriv_node, pb_instance) if pb_instance is not None else None
+
+        if self.stats is None:
+            semtree = semgrammar.get_semtree(deriv_node.tree_name, deriv_node.anchor, pb_instance=pb_instance, arguments=arguments)
+        else:
+            start_time = time.perf_counter()
+            try:
+                semtree = semgrammar.get_semtree(deriv_node.tree_name, deriv_node.anchor, pb_instance=pb_instance, arguments=arguments)
+            finally:
+                self.stats.add_time("lookup", time.perf_counter() - start_time)
+            self.stats.tree_built(deriv_node)
+        sites = DerivationTree.attachment_sites(semtree, depth)
+        return [deriv_node, depth, semtree, sites, 0]
+
+    def attach(self, parent, deriv_node, semtree):
+        """Substitutes/adjoins the composed semtree of deriv_node into its parent frame"""
+        parent_semtree, sites, depth = parent[2], parent[3], parent[1]
+        start_time = time.perf_counter() if self.stats is not None else None
+        if 'alpha' in deriv_node.tree_name:
+            sub_nodes = [s for s in sites.get((deriv_node.location, depth), []) if s.subst]
+            assert len(sub_nodes) == 1
+            sub_node = sub_nodes[0]
+            parent_semtree.substitute(semtree, sub_node.label(), node=sub_node)
+            stage = "substitute"
+        elif 'beta' in deriv_node.tree_name:
+            adj_nodes = sites.get((deriv_node.location, depth), [])
+            assert len(adj_nodes) == 1
+            adj_node = adj_nodes[0]
+            parent_semtree.adjoin(semtree, adj_node.label(), node=adj_node)
+            stage = "adjoin"
+        else:
+            return
+        if start_time is not None:
+            self.stats.add_time(stage, time.perf_counter() - start_time)
+
+class CompositionMemo(object):
+    """
+    Bounded memo of the composed SemTrees of derivation subtrees, shared by
+    every sentence of a run, so repeated noun phrases and modifiers
+    (alphaNXN[company] with betaDnx[the] adjoined...) are composed once.
+    Subtrees are keyed by their canonical structure: tree name, anchor,
+    frame choice (roleset and aligned arguments, which pick the frames of
+    verb trees, see DerivationTree.frame_choice) and the
+    (location, structure) of each child, along with the class of the
+    failure policy, as a subtree composed by skipping a failed child isn't
+    what a stricter policy would compose. Structures are interned to ints,
+    so keys are small flat tuples no matter how big the subtree is.
+
+    Memoized trees are never modified, as substitution and adjunction copy
+    the tree they attach. Their nodes keep the deriv_depth they were first
+    composed at, which is only used while composing their own children
+    """
+    CACHE_SIZE = 10000
+    MAX_STRUCTURES = 500000
+
+    def __init__(self):
+        self.structure_ids = {} # {(policy class, tree_name, anchor, frame choice, ((location, child id), ...)): id}
+        self.semtrees = OrderedDict() # {id: SemTree}, LRU order
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the memoized SemTree for key, or None"""
+        semtree = self.semtrees.get(key)
+        if semtree is None:
+            self.misses += 1
+            return None
+        self.semtrees.move_to_end(key)
+        self.hits += 1
+        return semtree
+
+    def add(self, key, semtree):
+        self.semtrees[key] = semtree
+        if len(self.semtrees) > self.CACHE_SIZE:
+            self.semtrees.popitem(last=False)
+
+    def subtree_keys(self, deriv_tree, semgrammar, policy=None):
+        """Returns {id(node): key} for every node of deriv_tree, composed under policy"""
+        # Ids are only comparable while the table lives, so it's reset (with
+        # the memo) between sentences if it grows too large
+        if len(self.structure_ids) > self.MAX_STRUCTURES:
+            self.structure_ids = {}
+            self.semtrees = OrderedDict()
+
+        # Pre-order with a stack, reversed so children come before parents
+        nodes = []
+        stack = [deriv_tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node)
+        alignment = deriv_tree.argument_alignment(semgrammar.propbank)
+        keys = {}
+        for node in reversed(nodes):
+            children = tuple((c.location, keys[id(c)]) for c in node)
+            structure = (type(policy), node.tree_name, node.anchor, node.frame_choice(semgrammar, alignment), children)
+            keys[id(node)] = self.structure_ids.setdefault(structure, len(self.structure_ids))
+        return keys
+
+class ArgumentAlignment(object):
+    """
+    Precomputed table from the Propbank arguments of a sentence to the nodes
+    of its derivation tree: argument pointer -> token span -> derivation node.
+    Nodes are identified by the token position of their anchor (see
+    DerivationTree.assign_token_positions), predicates by the token position
+    of their first piece, so every lookup is a single dictionary access
+    """
+
+    def __init__(self, deriv_tree, instances):
+        self.arg_to_node = {} # {(pred_pos, ARG0): [(tree_name, location, token_pos)]}
+        self.node_to_arg = {} # {(pred_pos, token_pos): ARG0}
+        self.arg_spans = {} # {(pred_pos, ARG0): [(start, end)]}
+
+        # Pre-order with a stack, so any depth of derivation works
+        nodes = []
+        stack = [deriv_tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node))
+        depths = {id(deriv_tree): 0}
+        for s in nodes:
+            for c in s:
+                depths[id(c)] = depths[id(s)] + 1
+
+        # Token span of each subtree; children come before parents in reverse pre-order
+        spans = {}
+        for s in reversed(nodes):
+            positions = [spans[id(c)] for c in s if id(c) in spans]
+            if s.token_pos is not None:
+                positions.append((s.token_pos, s.token_pos + 1))
+            if len(positions) > 0:
+                spans[id(s)] = (min(p[0] for p in positions), max(p[1] for p in positions))
+
+        self.span_index = {} # {(start, end): shallowest node with that span}
+        self.pos_index = {} # {token_pos: node anchored there}
+        for s in nodes:
+            if id(s) in spans and spans[id(s)] not in self.span_index:
+                self.span_index[spans[id(s)]] = s
+            if s.token_pos is not None:
+                self.pos_index[s.token_pos] = s
+        self.depths = {s.token_pos: depths[id(s)] for s in self.pos_index.values()}
+
+        for instance in instances:
+            if len(instance.token_positions) == 0:
+                continue
+            pred_pos = instance.token_positions[0]
+            # getattr b/c instances pickled before spans were stored don't have them
+            for argid, arg_spans in getattr(instance, 'argument_spans', []):
+                for span in arg_spans:
+                    node = self.find_node(span)
+                    if node is None or node.token_pos in instance.token_positions:
+                        continue
+                    self.arg_to_node.setdefault((pred_pos, argid), []).append((node.tree_name, node.location, node.token_pos))
+                    self.arg_spans.setdefault((pred_pos, argid), []).append(span)
+                    self.node_to_arg[(pred_pos, node.token_pos)] = argid
+
+    def find_node(self, span):
+        """
+        Returns the node whose subtree covers exactly span, else the shallowest
+        node anchored inside span (derivation and PTB constituents often
+        disagree on attachment), else None
+        """
+        node = self.span_index.get(span)
+        if node is not None:
+            return node
+        inside = [p for p in range(span[0], span[1]) if p in self.pos_index]
+        if len(inside) == 0:
+            return None
+        return self.pos_index[min(inside, key=lambda p: self.depths[p])]
+
+    def get_nodes(self, pred_pos, argid):
+        """Returns [(tree_name, location, token_pos)] of the nodes filling argid"""
+        return self.arg_to_node.get((pred_pos, argid), [])
+
+    def get_argument(self, pred_pos, token_pos):
+        """Returns the argid (ARG0, ARGM-TMP...) of the node at token_pos, or None"""
+        return self.node_to_arg.get((pred_pos, token_pos))
+
+    def child_arguments(self, deriv_node, instance):
+        """
+        Returns ((location, argid),) for the children of deriv_node (the
+        predicate of instance) that fill one of its arguments, e.g.
+        (('NP_0', 'ARG0'), ('NP_1', 'ARG1'))
+        """
+        if len(instance.token_positions) == 0:
+            return ()
+        pred_pos = instance.token_positions[0]
+        arguments = [(c.location, self.node_to_arg.get((pred_pos, c.token_pos))) for c in deriv_node]
+        return tuple((location, argid) for location, argid in arguments if argid is not None)
+
+class DerivationBundle(object):
+    """
+    Packed, random access store of a derivation corpus in a single file.
+    Each derivation is kept as parallel int32 arrays over its nodes in
+    pre-order (tree name id, anchor id, location id, parent index, token
+    position) with the strings interned once for the whole corpus, and an
+    offset index by (file_num, sent_num) lets any sentence be read without
+    scanning the corpus. The sentence itself isn't kept, so token positions
+    are only there if the bundle was built with the grammar to align them
+    (see DerivationTree.align_tokens). Layout:
+        MAGIC, trailer offset (uint64), records..., trailer (json strings + index)
+    """
+    MAGIC = b'XTDB2'
+    HEADER = struct.Struct('<Q')
+    FIELDS = 5 # tree name, anchor, location, parent, token_pos
+
+    def __init__(self, filename, strings, index):
+        self.filename = filename
+        self.strings = strings # [alphaNXN, chairman, NP_1, ...]
+        self.index = index # {(file_num, sent_num): (offset, num_nodes, filename)}
+        self.file = None
+        self.file_pid = None
+
+    def __getstate__(self):
+        # Open files can't be pickled (or shared with worker processes)
+        state = dict(self.__dict__)
+        state['file'] = None
+        state['file_pid'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        """Yields every DerivationTree in (file_num, sent_num) order"""
+        for file_num, sent_num in self.sentence_ids():
+            yield self.get(file_num, sent_num)
+
+    def sentence_ids(self):
+        """Returns the (file_num, sent_num) of every derivation, in order"""
+        return sorted(self.index, key=lambda k: (k[0], int(k[1])))
+
+    def get_file(self):
+        """Returns the open bundle file, reopening in new processes"""
+        if self.file is None or self.file_pid != os.getpid():
+            self.file = open(self.filename, 'rb')
+            self.file_pid = os.getpid()
+        return self.file
+
+    def get(self, file_num, sent_num):
+        """Returns the DerivationTree of a sentence, or None if it isn't in the bundle"""
+        entry = self.index.get((file_num, sent_num))
+        if entry is None:
+            return None
+        offset, num_nodes, filename = entry
+        f = self.get_file()
+        f.seek(offset)
+        values = array.array('i')
+        values.frombytes(f.read(4 * self.FIELDS * num_nodes))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return self.unpack(values, num_nodes, filename, (file_num, sent_num))
+
+    def unpack(self, values, num_nodes, filename, file_ids):
+        """Returns the DerivationTree given by the packed arrays of a record"""
+        tree_ids, anchor_ids, loc_ids, parents, token_positions = [
+            values[i * num_nodes:(i + 1) * num_nodes] for i in range(self.FIELDS)]
+        nodes = []
+        for i in range(num_nodes):
+            label = "%s[%s]" % (self.strings[tree_ids[i]], self.strings[anchor_ids[i]])
+            if loc_ids[i] >= 0:
+                label += "<%s>" % self.strings[loc_ids[i]]
+            token_pos = token_positions[i] if token_positions[i] >= 0 else None
+            node = DerivationTree(label, filename=filename, token_pos=token_pos, file_ids=file_ids)
+            nodes.append(node)
+            if parents[i] >= 0:
+                nodes[parents[i]].append(node)
+        return nodes[0]
+
+    @classmethod
+    def pack(cls, deriv_tree, string_ids):
+        """Returns the packed arrays of deriv_tree, adding new strings to string_ids"""
+        def intern(string):
+            if string is None:
+                return -1
+            if string not in string_ids:
+                string_ids[string] = len(string_ids)
+            return string_ids[string]
+
+        nodes = list(deriv_tree.subtrees())
+        node_index = {id(n): i for i, n in enumerate(nodes)}
+        parents = [-1] * len(nodes)
+        for i, n in enumerate(nodes):
+            for c in n:
+                parents[node_index[id(c)]] = i
+
+        values = array.array('i')
+        values.extend(intern(n.tree_name) for n in nodes)
+        values.extend(intern(n.anchor) for n in nodes)
+        values.extend(intern(n.location) for n in nodes)
+        values.extend(parents)
+        values.extend(n.token_pos if n.token_pos is not None else -1 for n in nodes)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    @classmethod
+    def build(cls, deriv_trees, filename, grammar=None):
+        """
+        Writes the (iterable of) deriv_trees to a new bundle file, returns the
+        bundle. Token positions are assigned first if grammar is given
+        """
+        string_ids = OrderedDict()
+        index = []
+        with open(filename, 'wb') as f:
+            f.write(cls.MAGIC)
+            f.write(cls.HEADER.pack(0))
+            for deriv_tree in deriv_trees:
+                if grammar is not None:
+                    deriv_tree.align_tokens(grammar)
+                values = cls.pack(deriv_tree, string_ids)
+                num_nodes = len(values) // cls.FIELDS
+                index.append([deriv_tree.file_num, deriv_tree.sentence_num, f.tell(), num_nodes, deriv_tree.filename])
+                f.write(values.tobytes())
+
+            trailer_offset = f.tell()
+            f.write(json.dumps({"strings": list(string_ids), "index": index}).encode('utf-8'))
+            f.seek(len(cls.MAGIC))
+            f.write(cls.HEADER.pack(trailer_offset))
+        return cls.from_file(filename)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Returns the bundle in filename, reading only its string table and index"""
+        with open(filename, 'rb') as f:
+            assert f.read(len(cls.MAGIC)) == cls.MAGIC, "%s is not a derivation bundle" % filename
+            trailer_offset, = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            f.seek(trailer_offset)
+            trailer = json.loads(f.read().decode('utf-8'))
+        index = {(file_num, sent_num): (offset, num_nodes, tree_filename)
+                 for file_num, sent_num, offset, num_nodes, tree_filename in trailer["index"]}
+        return cls(filename, trailer["strings"], index)
+
+    @classmethod
+    def load(cls, treedir=DATA_DIR + 'parse_trees', filename=DATA_DIR + 'derivation.bundle', grammar=None):
+        """
+        Returns the bundle from cache if exists (and is of the current
+        format), else packs the trees in treedir, see build
+        """
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                current = f.read(len(cls.MAGIC)) == cls.MAGIC
+            if current:
+                return cls.from_file(filename)
+        return cls.build(DerivationTree.stream(treedir), filename, grammar)
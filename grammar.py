@@ -22,7 +22,7 @@ class Grammar(object):
 
     def get_tree_family(self, tree_name):
         """Returns the tree's family, given the tree name"""
-        tree = self.get(tree_name)
+        tree = self.get(tree_name, copy=False)
         return tree.tree_family
 
     def get(self, tree_name, copy=True):
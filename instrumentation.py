@@ -0,0 +1,139 @@
+import json, time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from tagtree import SemTree
+
+class Instrumentation(object):
+    """
+    Records where composing derivations fails and where its time goes:
+        failures per error type and per elementary tree
+        time spent per stage (lookup of elementary semtrees, copy, rename,
+            substitute, adjoin; substitute/adjoin include their copy/rename)
+        one record per sentence
+    and exports all of it as JSON. Pass it as stats to get_parse_tree (or
+    DerivationComposer); without it the composer only pays an "is None"
+    check per node. Composing with it bypasses the composition memo (and
+    SemanticsCache reads), so every failure is seen. copy and rename are
+    timed only inside installed(), which wraps the SemTree methods for as
+    long as it's active
+    """
+    TIMED_METHODS = ['copy', 'rename']
+
+    def __init__(self):
+        self.failures = defaultdict(int) # {KeyError: 3}
+        self.tree_failures = defaultdict(lambda: defaultdict(int)) # {betaXX: {KeyError: 3}}
+        self.tree_counts = defaultdict(int) # {alphaNXN: 120}, elementary trees built
+        self.timings = defaultdict(float) # {substitute: 1.5}, seconds
+        self.calls = defaultdict(int) # {substitute: 80}
+        self.counts = defaultdict(int) # {sentences: 3, composed_sentences: 2}
+        self.sentences = [] # [{"sentence": "0001_0", "seconds": .., "nodes": .., "failures": [..], "error": ..}]
+        self.current = None
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] += seconds
+        self.calls[stage] += 1
+
+    def count(self, name):
+        self.counts[name] += 1
+
+    def tree_built(self, deriv_node):
+        self.tree_counts[deriv_node.tree_name] += 1
+
+    def failure(self, error, deriv_node):
+        """Records that deriv_node couldn't be built or attached"""
+        name = type(error).__name__
+        self.failures[name] += 1
+        self.tree_failures[deriv_node.tree_name][name] += 1
+        if self.current is not None:
+            self.current["failures"].append({"tree": deriv_node.tree_name, "anchor": deriv_node.anchor, "error": name})
+
+    def start_sentence(self, deriv_tree):
+        self.current = {
+            "sentence": "%s_%s" % (deriv_tree.file_num, deriv_tree.sentence_num),
+            "nodes": len(deriv_tree.treepositions()),
+            "failures": [],
+            "error": None,
+            "start": time.perf_counter(),
+        }
+
+    def end_sentence(self, error=None):
+        """Closes the current sentence's record, error being what stopped it (if anything)"""
+        record = self.current
+        record["seconds"] = time.perf_counter() - record.pop("start")
+        if error is not None:
+            record["error"] = type(error).__name__
+        self.sentences.append(record)
+        self.counts["sentences"] += 1
+        self.counts["failed_sentences" if error is not None else "composed_sentences"] += 1
+        self.current = None
+
+    @contextmanager
+    def installed(self):
+        """
+        Times every SemTree copy and rename while active. The methods are
+        replaced on the class, for the whole process: so only one
+        Instrumentation can be installed at a time, and copies made by other
+        threads meanwhile are counted too
+        """
+        assert not getattr(SemTree.copy, 'instrumented', False), "Another Instrumentation is installed"
+        originals = {name: SemTree.__dict__.get(name) for name in self.TIMED_METHODS}
+        for name in self.TIMED_METHODS:
+            setattr(SemTree, name, self.timed(name, getattr(SemTree, name)))
+        try:
+            yield self
+        finally:
+            for name, original in originals.items():
+                if original is None:
+                    delattr(SemTree, name) # Was inherited from TAGTree
+                else:
+                    setattr(SemTree, name, original)
+
+    def timed(self, stage, method):
+        """Returns method wrapped to add its running time to stage"""
+        def timed_method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+        timed_method.instrumented = True
+        return timed_method
+
+    def to_dict(self):
+        return {
+            "failures": dict(self.failures),
+            "tree_failures": {tree: dict(errors) for tree, errors in self.tree_failures.items()},
+            "tree_counts": dict(self.tree_counts),
+            "timings": dict(self.timings),
+            "calls": dict(self.calls),
+            "counts": dict(self.counts),
+            "sentences": self.sentences,
+        }
+
+    def export(self, filename):
+        """Writes the whole run's data to filename as JSON"""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def merge(cls, dicts):
+        """Returns the to_dict of several runs (i.e. processes or shards) combined"""
+        merged = cls()
+        for d in dicts:
+            for name, count in d["failures"].items():
+                merged.failures[name] += count
+            for tree, errors in d["tree_failures"].items():
+                for name, count in errors.items():
+                    merged.tree_failures[tree][name] += count
+            for tree, count in d["tree_counts"].items():
+                merged.tree_counts[tree] += count
+            for stage, seconds in d["timings"].items():
+                merged.timings[stage] += seconds
+            for stage, count in d["calls"].items():
+                merged.calls[stage] += count
+            for name, count in d["counts"].items():
+                merged.counts[name] += count
+            merged.sentences += d["sentences"]
+        return merged.to_dict()
@@ -0,0 +1,111 @@
+import inflection
+
+from collections import OrderedDict
+from nltk.corpus import wordnet
+
+class AnchorLemmatizer(object):
+    """
+    Maps the surface form of a derivation anchor (jumped, chased) to a lemma
+    from a known vocabulary (typically the VerbNet lemmas). Results are kept
+    in a bounded memo keyed by (surface form, POS), which can be filled ahead
+    of time for the whole corpus with precompute
+    """
+    CACHE_SIZE = 50000
+
+    VOWELS = "aeiou"
+    SIBILANTS = ("s", "x", "z", "ch", "sh") # Stems that take -es rather than -s
+    KEPT_DOUBLES = "lsfz" # Doubled letters that may belong to the lemma (fill, pass)
+
+    def __init__(self, lemmas):
+        self.lemmas = set(lemmas)
+        self.memo = OrderedDict() # {(jumped, v) -> jump}, LRU order
+        self.use_wordnet = True
+
+    def lemmatize(self, word, pos='v'):
+        """Returns the lemma for word in the vocabulary, or None if there is none"""
+        key = (word, pos)
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key]
+
+        lemma = self.find_lemma(word, pos)
+        self.memo[key] = lemma
+        if len(self.memo) > self.CACHE_SIZE:
+            self.memo.popitem(last=False)
+        return lemma
+
+    def precompute(self, words):
+        """Returns self after memoizing every (word, pos) pair in words"""
+        for word, pos in words:
+            self.lemmatize(word, pos)
+        return self
+
+    def find_lemma(self, word, pos):
+        """Returns the lemma for word without using the memo"""
+        word = word.lower()
+        if word in self.lemmas:
+            return word
+
+        candidates = []
+        if pos == 'v':
+            candidates += self.verb_candidates(word)
+        elif pos == 'n':
+            candidates.append(inflection.singularize(word))
+        candidates += self.wordnet_candidates(word, pos)
+
+        for c in candidates:
+            if c in self.lemmas:
+                return c
+        return None
+
+    def verb_candidates(self, word):
+        """
+        Returns possible lemmas of an inflected verb, most likely first,
+        following the English spelling rules for -s, -ed and -ing. The
+        ranking matters when both candidates are verbs (hopes -> hope, not hop)
+        """
+        if word.endswith("ies") and len(word) > 4:
+            return [word[:-3] + "y", word[:-1]] # tries -> try, dies -> die
+        if word.endswith("s") and not word.endswith("ss"):
+            if word.endswith("es") and word[:-2].endswith(self.SIBILANTS):
+                return [word[:-2], word[:-1]] # passes -> pass, loses -> lose
+            elif word.endswith("es"):
+                return [word[:-1], word[:-2]] # hopes -> hope, goes -> go
+            return [word[:-1]]
+        for suffix in ["ed", "ing"]:
+            if word.endswith(suffix) and len(word) > len(suffix) + 1:
+                return self.stem_candidates(word[:-len(suffix)], suffix)
+        return []
+
+    def stem_candidates(self, stem, suffix):
+        """Returns possible lemmas for the stem left by removing -ed or -ing, most likely first"""
+        vowels = self.VOWELS
+        if suffix == "ed" and stem.endswith("e"):
+            return [stem + "e", stem] # agreed -> agree
+        if suffix == "ing" and stem.endswith("y") and len(stem) <= 2:
+            return [stem[:-1] + "ie", stem] # lying -> lie
+        if len(stem) > 2 and stem[-1] == stem[-2] and stem[-1] not in vowels:
+            # Doubled final consonant: stopped -> stop, but filled -> fill
+            if stem[-1] in self.KEPT_DOUBLES:
+                return [stem, stem[:-1]]
+            return [stem[:-1], stem]
+        if (len(stem) >= 2 and stem[-1] not in vowels + "wxy" and stem[-2] in vowels
+                and (len(stem) == 2 or stem[-3] not in vowels)):
+            # Consonant-vowel-consonant ending whose consonant wasn't doubled,
+            # so the lemma most likely lost an "e": hoping -> hope, wading -> wade
+            return [stem + "e", stem]
+        return [stem, stem + "e"] # singing -> sing, jumped -> jump
+
+    def wordnet_candidates(self, word, pos):
+        """
+        Returns WordNet's base form for word (handles irregulars like ran ->
+        run), or nothing if the WordNet data is not installed
+        """
+        if not self.use_wordnet:
+            return []
+        try:
+            lemma = wordnet.morphy(word, pos)
+        except LookupError:
+            self.use_wordnet = False
+            return []
+        return [lemma] if lemma is not None else []
@@ -0,0 +1,513 @@
+import argparse, glob, json, multiprocessing, os, socket, tempfile, time
+
+from collections import defaultdict
+
+from derivation import DerivationTree
+from instrumentation import Instrumentation
+from semcache import SemanticsCache
+from semgrammar import SemTreeGrammar, CoverageReport
+from semserializer import SemanticsReader, SemanticsWriter
+from vnet_constants import DATA_DIR
+
+class AnnotationPipeline(object):
+    """
+    Batch driver that annotates a derivation corpus with semantics. Parse
+    files are split into fixed shards, which are annotated over a pool of
+    processes (each holding its own loaded SemTreeGrammar) and streamed to
+    one JSON Lines file per shard (see SemanticsWriter). A checkpoint is
+    updated as shards finish, so a run that was killed picks up at the
+    first unfinished shard. Layout of output_dir:
+        shards.json        the shard plan, [[parse filename, ...], ...]
+        checkpoint.json    {"done": {shard id: {"success": 10, "KeyError": 2, ...}}}
+        shard_00000.jsonl  records of shard 0, in parse file order
+        shard_00000.stats.json, stats.json
+                           Instrumentation of shard 0 and of the whole run,
+                           only if instrument is set
+        coverage.json      CoverageReport of treedir, written by coverage
+    """
+    SHARD_SIZE = 500
+
+    # Per process resources, see init_worker
+    worker_semgrammar = None
+    worker_cache = None
+    worker_instrument = False
+    worker_loader = None # loader and cache_dir the resources were loaded from
+    worker_cache_dir = None
+
+    def __init__(self, output_dir, treedir=DATA_DIR + 'parse_trees', sections=None,
+        shard_size=SHARD_SIZE, processes=None, cache_dir=None, loader=None, instrument=False):
+        if loader is None:
+            loader = SemTreeGrammar.load
+        self.output_dir = output_dir
+        self.treedir = treedir
+        self.sections = sections
+        self.shard_size = shard_size
+        self.processes = processes
+        self.cache_dir = cache_dir # SemanticsCache directory, if any
+        self.loader = loader # Returns the SemTreeGrammar, must be picklable
+        self.instrument = instrument
+
+    def plan(self):
+        """
+        Returns the shard plan, creating it on the first run. A resumed run
+        keeps the plan it started with even if parse files were added since
+        """
+        plan_filename = self.plan_path()
+        if os.path.exists(plan_filename):
+            with open(plan_filename, 'r') as f:
+                return json.load(f)
+
+        filenames = DerivationTree.tree_filenames(self.treedir, self.sections)
+        shards = [filenames[i:i + self.shard_size] for i in range(0, len(filenames), self.shard_size)]
+        os.makedirs(self.output_dir, exist_ok=True)
+        AnnotationPipeline.write_json(plan_filename, shards)
+        return shards
+
+    def plan_path(self):
+        return os.path.join(self.output_dir, 'shards.json')
+
+    def shard_path(self, shard_id):
+        return os.path.join(self.output_dir, 'shard_%05d.jsonl' % shard_id)
+
+    def merge_stats(self):
+        """Writes stats.json, the Instrumentation of every shard that has one, combined"""
+        stats = []
+        for shard_id in range(len(self.plan())):
+            stats_filename = AnnotationPipeline.stats_path(self.shard_path(shard_id))
+            if os.path.exists(stats_filename):
+                with open(stats_filename, 'r') as f:
+                    stats.append(json.load(f))
+        AnnotationPipeline.write_json(os.path.join(self.output_dir, 'stats.json'), Instrumentation.merge(stats))
+
+    def load_checkpoint(self):
+        checkpoint_filename = os.path.join(self.output_dir, 'checkpoint.json')
+        if not os.path.exists(checkpoint_filename):
+            return {"done": {}}
+        with open(checkpoint_filename, 'r') as f:
+            return json.load(f)
+
+    def save_checkpoint(self, checkpoint):
+        AnnotationPipeline.write_json(os.path.join(self.output_dir, 'checkpoint.json'), checkpoint)
+
+    def pending_jobs(self):
+        """Returns the annotate_shard jobs of every shard not finished yet"""
+        shards = self.plan()
+        done = self.load_checkpoint()["done"]
+        return [(shard_id, filenames, self.shard_path(shard_id))
+                for shard_id, filenames in enumerate(shards)
+                if str(shard_id) not in done or not os.path.exists(self.shard_path(shard_id))]
+
+    def run(self):
+        """
+        Annotates every unfinished shard and returns the total counts
+        ({"success": ..., error name: ...}) over all shards
+        """
+        self.remove_temp_files()
+        jobs = self.pending_jobs()
+        checkpoint = self.load_checkpoint()
+
+        # Loaded here first so forked workers share it instead of loading their own
+        AnnotationPipeline.init_worker(self.loader, self.cache_dir, self.instrument)
+        if self.processes == 1 or len(jobs) <= 1:
+            results = (AnnotationPipeline.annotate_shard(job) for job in jobs)
+            for shard_id, counts in results:
+                checkpoint["done"][str(shard_id)] = counts
+                self.save_checkpoint(checkpoint)
+        else:
+            with multiprocessing.Pool(self.processes, initializer=AnnotationPipeline.init_worker,
+                initargs=(self.loader, self.cache_dir, self.instrument)) as pool:
+                for shard_id, counts in pool.imap_unordered(AnnotationPipeline.annotate_shard, jobs):
+                    checkpoint["done"][str(shard_id)] = counts
+                    self.save_checkpoint(checkpoint)
+
+        if self.instrument:
+            self.merge_stats()
+        return AnnotationPipeline.total_counts(checkpoint["done"].values())
+
+    def coverage(self, tree_families=None, tree_set=()):
+        """
+        Writes coverage.json, the CoverageReport of the derivations in
+        treedir (by default for the trees the grammar can annotate, see
+        CoverageReport.from_derivations), and returns the report
+        """
+        AnnotationPipeline.init_worker(self.loader, self.cache_dir, self.instrument)
+        deriv_trees = DerivationTree.stream(self.treedir, self.sections, self.processes)
+        report = CoverageReport.from_derivations(deriv_trees, AnnotationPipeline.worker_semgrammar, tree_families, tree_set)
+        os.makedirs(self.output_dir, exist_ok=True)
+        AnnotationPipeline.write_json(os.path.join(self.output_dir, 'coverage.json'), report.to_dict())
+        return report
+
+    def remove_temp_files(self):
+        """
+        Removes the temp files left in output_dir by a run that was killed
+        (see annotate_files and write_json). Only safe while no other run is
+        writing to output_dir
+        """
+        for filename in glob.glob(os.path.join(self.output_dir, '*.tmp')):
+            os.remove(filename)
+
+    def results(self):
+        """Yields (sentence, Semantics) over every finished shard, in shard order"""
+        for shard_id in range(len(self.plan())):
+            if os.path.exists(self.shard_path(shard_id)):
+                with open(self.shard_path(shard_id), 'r') as f:
+                    for result in SemanticsReader(f):
+                        yield result
+
+    @classmethod
+    def init_worker(cls, loader, cache_dir=None, instrument=False):
+        """
+        Loads the per process resources, unless inherited from the parent
+        already. Resources loaded for another pipeline (a different loader
+        or cache_dir) are replaced
+        """
+        cls.worker_instrument = instrument
+        if cls.worker_semgrammar is None or cls.worker_loader != loader:
+            cls.worker_semgrammar = loader()
+            cls.worker_loader = loader
+            # A cache is only valid for the resources it was loaded after
+            cls.worker_cache = cls.worker_cache_dir = None
+        if cls.worker_cache_dir != cache_dir:
+            cls.worker_cache = SemanticsCache.load(cache_dir) if cache_dir is not None else None
+            cls.worker_cache_dir = cache_dir
+
+    @classmethod
+    def annotate_shard(cls, job):
+        """
+        Annotates the parse files of a shard and writes their records to
+        output_path, which only appears once the whole shard is written.
+        Returns (shard_id, counts)
+        """
+        shard_id, filenames, output_path = job
+        if not cls.worker_instrument:
+            return shard_id, cls.annotate_files(filenames, output_path)
+
+        stats = Instrumentation()
+        with stats.installed():
+            counts = cls.annotate_files(filenames, output_path, stats=stats)
+        # Written before the shard is reported done, so it's never missing for a finished shard
+        cls.write_json(cls.stats_path(output_path), stats.to_dict())
+        return shard_id, counts
+
+    @classmethod
+    def annotate_files(cls, filenames, output_path, stats=None):
+        """Writes the records of the parse files in filenames to output_path, returns counts"""
+        counts = defaultdict(int)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            writer = SemanticsWriter(f)
+            for filename in filenames:
+                # Any error in a sentence (an unreadable parse file, a bug hit
+                # by one derivation) is counted under its name and fails that
+                # sentence only
+                try:
+                    deriv_tree = DerivationTree.from_file(filename)
+                except Exception as e:
+                    counts[type(e).__name__] += 1
+                    continue
+                if deriv_tree is None:
+                    counts["no_derivation"] += 1
+                    continue
+
+                try:
+                    if cls.worker_cache is not None:
+                        record = cls.worker_cache.get_record(deriv_tree, cls.worker_semgrammar, stats=stats)
+                    else:
+                        record = SemanticsCache.compute(deriv_tree, cls.worker_semgrammar, stats=stats)
+                except Exception as e:
+                    record = {"error": type(e).__name__}
+                if "semantics" not in record:
+                    counts[record["error"]] += 1
+                    continue
+
+                sentence = "%s_%s.parse" % (deriv_tree.file_num, deriv_tree.sentence_num)
+                writer.write_string(sentence, record["semantics"])
+                counts["success"] += 1
+        os.replace(tmp_path, output_path)
+        return dict(counts)
+
+    @classmethod
+    def stats_path(cls, output_path):
+        return output_path[:-len('.jsonl')] + '.stats.json'
+
+    @classmethod
+    def total_counts(cls, shard_counts):
+        totals = defaultdict(int)
+        for counts in shard_counts:
+            for name, count in counts.items():
+                totals[name] += count
+        return dict(totals)
+
+    @classmethod
+    def write_json(cls, filename, obj):
+        """Writes obj to filename through a temp file, so readers never see half of it"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, filename)
+
+class ShardQueue(object):
+    """
+    Work queue over the shards of a plan, kept entirely in a shared
+    directory (local or NFS, no other services) so workers on any number of
+    hosts can take shards from it. Layout of queue_dir:
+        shard_00003.lease  held by the worker annotating shard 3: {"owner": "host:pid"}
+        shard_00003.done   counts of finished shard 3
+    Leases are taken with link(), which is atomic on NFS as well as local
+    filesystems, and renewed by touching them. A lease that wasn't renewed
+    for lease_seconds belongs to a dead worker and may be taken over, so
+    lease_seconds should be well over the clock skew between hosts. Leases
+    are only ever broken or dropped by first renaming them to a name of the
+    worker's own (see move_lease), so a worker can't remove a lease it
+    didn't mean to
+    """
+    LEASE_SECONDS = 1800
+
+    def __init__(self, queue_dir, num_shards, lease_seconds=LEASE_SECONDS):
+        self.queue_dir = queue_dir
+        self.num_shards = num_shards
+        self.lease_seconds = lease_seconds
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def lease_path(self, shard_id):
+        return os.path.join(self.queue_dir, 'shard_%05d.lease' % shard_id)
+
+    def done_path(self, shard_id):
+        return os.path.join(self.queue_dir, 'shard_%05d.done' % shard_id)
+
+    def is_done(self, shard_id):
+        return os.path.exists(self.done_path(shard_id))
+
+    def unfinished(self):
+        """Returns the ids of shards that aren't done"""
+        return [shard_id for shard_id in range(self.num_shards) if not self.is_done(shard_id)]
+
+    def claim(self):
+        """Returns the id of a shard now leased to this worker, or None if no shard is free"""
+        for shard_id in self.unfinished():
+            if self.try_lease(shard_id):
+                # Another worker may have finished it between the listing and the lease
+                if self.is_done(shard_id):
+                    self.release(shard_id)
+                    continue
+                return shard_id
+        return None
+
+    def read_lease(self, path):
+        """Returns (owner, mtime) of the lease file at path, or None if there's none"""
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)["owner"], os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def move_lease(self, shard_id, owner, mtime=None):
+        """
+        Returns True if the lease on shard_id was removed, which it is only if
+        it's still held by owner (and was last renewed at mtime, if given).
+        The lease is first renamed to a name of this worker's own, so no other
+        worker can touch it, and checked there; one that doesn't match (i.e. a
+        new lease taken since it was looked at) is put back
+        """
+        path = self.lease_path(shard_id)
+        moved_path = "%s.%s.moved" % (path, self.owner)
+        try:
+            os.rename(path, moved_path)
+        except FileNotFoundError:
+            return False
+        lease = self.read_lease(moved_path)
+        if lease is not None and lease[0] == owner and (mtime is None or lease[1] == mtime):
+            os.remove(moved_path)
+            return True
+        try:
+            os.link(moved_path, path)
+        except FileExistsError:
+            # Taken again in the meantime, whoever holds it now does the shard
+            pass
+        os.remove(moved_path)
+        return False
+
+    def try_lease(self, shard_id):
+        """Returns True if the lease on shard_id was taken, breaking it first if expired"""
+        path = self.lease_path(shard_id)
+        lease = self.read_lease(path)
+        if lease is not None:
+            owner, mtime = lease
+            if mtime + self.lease_seconds >= time.time():
+                return False
+            # Only one of the workers that saw the expired lease can break it,
+            # and only if it wasn't renewed or taken over since
+            if not self.move_lease(shard_id, owner, mtime):
+                return False
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.queue_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"owner": self.owner}, f)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def renew(self, shard_ids):
+        """Touches the leases on shard_ids that this worker still holds"""
+        for shard_id in shard_ids:
+            lease = self.read_lease(self.lease_path(shard_id))
+            if lease is None or lease[0] != self.owner:
+                # Taken over after expiring, the other worker's output is the same
+                continue
+            try:
+                os.utime(self.lease_path(shard_id))
+            except FileNotFoundError:
+                pass
+
+    def complete(self, shard_id, counts):
+        """Marks shard_id as done (its output must already be in place) and drops its lease"""
+        AnnotationPipeline.write_json(self.done_path(shard_id), counts)
+        self.release(shard_id)
+
+    def release(self, shard_id):
+        """Drops the lease on shard_id if this worker still holds it"""
+        self.move_lease(shard_id, self.owner)
+
+    def counts(self):
+        """Returns {shard id: counts} of every finished shard"""
+        counts = {}
+        for shard_id in range(self.num_shards):
+            if self.is_done(shard_id):
+                with open(self.done_path(shard_id), 'r') as f:
+                    counts[shard_id] = json.load(f)
+        return counts
+
+class DistributedPipeline(AnnotationPipeline):
+    """
+    AnnotationPipeline spread over several hosts sharing output_dir. The
+    coordinator writes the shard plan (prepare) and later merges the shard
+    outputs into one result set (merge); every host runs work, which takes
+    shards from a ShardQueue in output_dir/queue and annotates them over
+    its own pool of processes until no shard is left
+    """
+    POLL_SECONDS = 5
+
+    def __init__(self, output_dir, lease_seconds=ShardQueue.LEASE_SECONDS, **kwargs):
+        AnnotationPipeline.__init__(self, output_dir, **kwargs)
+        self.lease_seconds = lease_seconds
+
+    def queue(self):
+        return ShardQueue(os.path.join(self.output_dir, 'queue'), len(self.plan()), self.lease_seconds)
+
+    def prepare(self):
+        """Writes the shard plan and queue to output_dir, returns the number of shards"""
+        num_shards = len(self.plan())
+        self.queue()
+        return num_shards
+
+    def check_prepared(self):
+        """Raises ValueError unless the shard plan was written (see prepare)"""
+        if not os.path.exists(self.plan_path()):
+            raise ValueError("No shard plan in %s, run prepare first" % self.output_dir)
+
+    def work(self):
+        """
+        Annotates shards from the queue until none is free, returns the
+        counts of the shards done by this host. Shards still leased by
+        other hosts are left to them (or to whoever finds them expired).
+        Raises ValueError if prepare hasn't been run: a plan made by each
+        host from what it sees of treedir could differ between hosts
+        """
+        self.check_prepared()
+        shards = self.plan()
+        queue = self.queue()
+        processes = self.processes if self.processes is not None else multiprocessing.cpu_count()
+        AnnotationPipeline.init_worker(self.loader, self.cache_dir, self.instrument)
+
+        done = []
+        with multiprocessing.Pool(processes, initializer=AnnotationPipeline.init_worker,
+            initargs=(self.loader, self.cache_dir, self.instrument)) as pool:
+            in_flight = {} # {shard id: AsyncResult}
+            while True:
+                while len(in_flight) < processes:
+                    shard_id = queue.claim()
+                    if shard_id is None:
+                        break
+                    job = (shard_id, shards[shard_id], self.shard_path(shard_id))
+                    in_flight[shard_id] = pool.apply_async(AnnotationPipeline.annotate_shard, (job,))
+                if len(in_flight) == 0:
+                    break
+
+                time.sleep(min(self.POLL_SECONDS, self.lease_seconds / 4.0))
+                for shard_id, result in list(in_flight.items()):
+                    if result.ready():
+                        shard_id, counts = result.get()
+                        queue.complete(shard_id, counts)
+                        done.append(counts)
+                        del in_flight[shard_id]
+                queue.renew(in_flight)
+
+        return AnnotationPipeline.total_counts(done)
+
+    def merge(self, output_filename, wait=True):
+        """
+        Concatenates the outputs of every shard, in shard order, into
+        output_filename and returns the total counts. If wait, first waits
+        for shards still being annotated, else raises if any are missing
+        """
+        self.check_prepared()
+        queue = self.queue()
+        while len(queue.unfinished()) > 0:
+            if not wait:
+                raise ValueError("Shards not finished: %s" % queue.unfinished())
+            time.sleep(self.POLL_SECONDS)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_filename)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as out:
+            for shard_id in range(queue.num_shards):
+                with open(self.shard_path(shard_id), 'r') as f:
+                    for line in f:
+                        out.write(line)
+        os.replace(tmp_path, output_filename)
+        if self.instrument:
+            self.merge_stats()
+        return AnnotationPipeline.total_counts(queue.counts().values())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Annotate a derivation corpus with semantics")
+    parser.add_argument('output_dir')
+    parser.add_argument('--mode', choices=['local', 'prepare', 'work', 'merge', 'coverage'], default='local',
+        help="local: this host only; prepare/work/merge: several hosts sharing output_dir; "
+        "coverage: only write the coverage report")
+    parser.add_argument('--tree-families', nargs='*', default=None,
+        help="Annotated tree families (coverage mode), by default the ones the grammar can annotate")
+    parser.add_argument('--tree-set', nargs='*', default=[], help="Annotated trees, with --tree-families")
+    parser.add_argument('--merged', default=None, help="Merged output file (merge mode)")
+    parser.add_argument('--lease-seconds', type=int, default=ShardQueue.LEASE_SECONDS)
+    parser.add_argument('--treedir', default=DATA_DIR + 'revised_parse_trees')
+    parser.add_argument('--sections', nargs='*', help="WSJ sections, i.e. 00 23")
+    parser.add_argument('--shard-size', type=int, default=AnnotationPipeline.SHARD_SIZE)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--instrument', action='store_true', help="Also write failure/timing stats")
+    args = parser.parse_args()
+
+    sections = set(args.sections) if args.sections else None
+    options = dict(treedir=args.treedir, sections=sections, shard_size=args.shard_size,
+        processes=args.processes, cache_dir=args.cache_dir, instrument=args.instrument)
+    if args.mode == 'local':
+        counts = AnnotationPipeline(args.output_dir, **options).run()
+    elif args.mode == 'coverage':
+        tree_families = set(args.tree_families) if args.tree_families is not None else None
+        report = AnnotationPipeline(args.output_dir, **options).coverage(tree_families, set(args.tree_set))
+        counts = {"sentences": report.sentences, "covered": report.covered, "prunable": report.prunable, "lost": report.lost}
+    else:
+        pipeline = DistributedPipeline(args.output_dir, lease_seconds=args.lease_seconds, **options)
+        if args.mode == 'prepare':
+            counts = {"shards": pipeline.prepare()}
+        elif args.mode == 'work':
+            counts = pipeline.work()
+        else:
+            merged = args.merged if args.merged is not None else os.path.join(args.output_dir, 'semantics.jsonl')
+            counts = pipeline.merge(merged)
+    print(" ".join("%s %d" % (name, count) for name, count in sorted(counts.items())))
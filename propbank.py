@@ -1,7 +1,8 @@
-import nltk, os, pickle
+import multiprocessing, nltk, os, pathlib, pickle, sqlite3
 
-from collections import defaultdict
-from nltk.corpus.reader import CategorizedBracketParseCorpusReader, PropbankCorpusReader
+from collections import defaultdict, OrderedDict
+from nltk.corpus.reader import BracketParseCorpusReader, CategorizedBracketParseCorpusReader, PropbankCorpusReader
+from nltk.corpus.reader.propbank import PropbankTreePointer
 from nltk.corpus.util import LazyCorpusLoader
 from nltk.corpus import propbank
 
@@ -14,19 +15,40 @@ class Propbank(object):
     Provides an interface to access both of these
     """
 
-    def __init__(self, role_dict, instance_dict):
+    def __init__(self, role_dict, instance_dict, position_dict=None):
+        if position_dict is None:
+            position_dict = {}
         self.role_dict = role_dict
-        self.instance_dict = instance_dict
+        self.instance_dict = instance_dict # {(0001, 0): {join: PropbankInstance}}
+        self.position_dict = position_dict # {(0001, 0): {3: PropbankInstance}}, see PropbankInstance
 
     def get_role(self, roleset_id):
         """Returns role given roleset_id"""
         return self.role_dict[roleset_id]
 
-    def get_instance(self, file_num, sent_num, word):
-        return self.instance_dict[(file_num, sent_num)].get(word)
+    def get_instance(self, file_num, sent_num, word, token_pos=None):
+        """
+        Returns the instance whose predicate is word. If the token position of
+        word is known, only the instance at that position is used (or None),
+        which tells apart repeated verbs and matches split predicates. The
+        word alone is only used for sentences without position data
+        """
+        # getattr b/c pickles from before the index existed don't have it
+        positions = getattr(self, 'position_dict', {}).get((file_num, sent_num), {})
+        if token_pos is not None and len(positions) > 0:
+            instance = positions.get(token_pos)
+            return instance if instance is not None and instance.has_word(word) else None
+        return self.instance_dict.get((file_num, sent_num), {}).get(word)
+
+    def get_instances(self, file_num, sent_num):
+        """Returns every instance in a sentence, each predicate once"""
+        key = (file_num, sent_num)
+        instances = list(self.instance_dict.get(key, {}).values())
+        instances += getattr(self, 'position_dict', {}).get(key, {}).values()
+        return PropbankInstance.unique(instances)
 
-    def get_vn_classes(self, file_num, sent_num, word):
-        instance = self.get_instance(file_num, sent_num, word)
+    def get_vn_classes(self, file_num, sent_num, word, token_pos=None):
+        instance = self.get_instance(file_num, sent_num, word, token_pos=token_pos)
         if instance is None:
             return []
         roleset_id = instance.roleset_id
@@ -50,12 +72,10 @@ class Propbank(object):
             ptb
         ) # Must be defined *after* ptb corpus.
 
-        role_dict = {}
-        for roleset_xml in propbank_ptb.rolesets():
-            role = Role.fromxml(roleset_xml)
-            role_dict[role.roleset_id] = role
+        role_dict = Propbank.read_roles(propbank_ptb)
 
         instance_dict = defaultdict(dict)
+        position_dict = defaultdict(dict)
         pb_instances = propbank_ptb.instances()
         for instance in pb_instances:
             instance.fileid = instance.fileid.lower()
@@ -66,28 +86,176 @@ class Propbank(object):
 
             if isinstance(predicate, nltk.corpus.reader.propbank.PropbankTreePointer):
                 key = Propbank.pointer_to_word(predicate, tree)
+                pieces = [predicate]
             elif isinstance(predicate, nltk.corpus.reader.propbank.PropbankSplitTreePointer):
                 key = tuple([Propbank.pointer_to_word(p, tree) for p in predicate.pieces])
+                pieces = predicate.pieces
             else:
                 ### TODO: Investigate when this is the case ###
                 #assert False
                 continue
 
-            pb_instance = PropbankInstance(instance.fileid, file_num, sentnum, key, instance.roleset, instance.arguments)
+            token_index = Propbank.leaf_to_token_index(tree)
+            token_positions = [token_index[p.wordnum] for p in pieces if p.wordnum in token_index]
+            argument_spans = Propbank.argument_spans(instance.arguments, tree, token_index)
+            pb_instance = PropbankInstance(instance.fileid, file_num, sentnum, key, instance.roleset, instance.arguments, token_positions, argument_spans)
             instance_dict[(file_num, sentnum)][key] = pb_instance
+            for token_pos in token_positions:
+                position_dict[(file_num, sentnum)][token_pos] = pb_instance
+
+        return Propbank(role_dict, instance_dict, position_dict)
+
+    @classmethod
+    def read_roles(cls, propbank_reader):
+        """Returns {roleset_id: Role} for every roleset in the frame files"""
+        role_dict = {}
+        for roleset_xml in propbank_reader.rolesets():
+            role = Role.fromxml(roleset_xml)
+            role_dict[role.roleset_id] = role
+        return role_dict
+
+    @classmethod
+    def from_files(cls, processes=None):
+        """
+        Returns a fully populated Propbank by reading prop.txt and the PTB .mrg
+        files directly. prop.txt is ordered by file, so each WSJ file's trees
+        are read in a single pass and dropped once its instances are built,
+        and pointers are resolved against each sentence's leaves computed once.
+        WSJ sections are read in parallel over a pool of processes (all cores
+        by default, processes=1 reads in this process)
+        """
+        role_dict = Propbank.read_roles(propbank)
+        ptb_root = nltk.data.find('corpora/ptb').path
 
-        return Propbank(role_dict, instance_dict)
+        # Group lines by section (wsj/00), keeping file order
+        section_lines = defaultdict(list)
+        with open(propbank.abspath('prop.txt').path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0:
+                    section_lines[line.split("/", 2)[1]].append(line)
+
+        jobs = [(ptb_root, section_lines[section]) for section in sorted(section_lines)]
+        if processes == 1:
+            section_dicts = [cls.read_section(job) for job in jobs]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                section_dicts = pool.map(cls.read_section, jobs)
+
+        instance_dict = defaultdict(dict)
+        position_dict = defaultdict(dict)
+        for section_instance_dict, section_position_dict in section_dicts:
+            for key, instances in section_instance_dict.items():
+                instance_dict[key].update(instances)
+            for key, instances in section_position_dict.items():
+                position_dict[key].update(instances)
+
+        return Propbank(role_dict, instance_dict, position_dict)
 
     @classmethod
-    def pointer_to_word(cls, pointer, tree):
+    def read_section(cls, job):
+        """
+        Returns the instance dict ({(file_num, sentnum): {word: PropbankInstance}})
+        and position dict ({(file_num, sentnum): {token_pos: PropbankInstance}})
+        for the prop.txt lines of a single WSJ section, given as (ptb_root, lines)
+        """
+        ptb_root, lines = job
+        instance_dict = defaultdict(dict)
+        position_dict = defaultdict(dict)
+
+        fileid, trees, leaf_positions, token_indices = None, None, {}, {}
+        for line in lines:
+            instance = nltk.corpus.reader.propbank.PropbankInstance.parse(line)
+            if instance.fileid != fileid:
+                # Moving on to the next file, so drop the previous file's trees
+                fileid = instance.fileid
+                trees = BracketParseCorpusReader(ptb_root, [fileid.upper()]).parsed_sents(fileid.upper())
+                leaf_positions, token_indices = {}, {}
+
+            sentnum = instance.sentnum
+            tree = trees[sentnum]
+            if sentnum not in leaf_positions:
+                leaf_positions[sentnum] = tree.treepositions('leaves')
+                token_indices[sentnum] = Propbank.leaf_to_token_index(tree)
+            positions = leaf_positions[sentnum]
+
+            predicate = instance.predicate
+            if isinstance(predicate, nltk.corpus.reader.propbank.PropbankTreePointer):
+                key = Propbank.pointer_to_word(predicate, tree, positions)
+                pieces = [predicate]
+            elif isinstance(predicate, nltk.corpus.reader.propbank.PropbankSplitTreePointer):
+                key = tuple([Propbank.pointer_to_word(p, tree, positions) for p in predicate.pieces])
+                pieces = predicate.pieces
+            else:
+                continue
+
+            token_index = token_indices[sentnum]
+            token_positions = [token_index[p.wordnum] for p in pieces if p.wordnum in token_index]
+            argument_spans = Propbank.argument_spans(instance.arguments, tree, token_index, positions)
+            file_num = fileid.split("/")[-1].split(".")[0].replace("wsj_", "")
+            pb_instance = PropbankInstance(fileid, file_num, str(sentnum), key, instance.roleset, instance.arguments, token_positions, argument_spans)
+            instance_dict[(file_num, str(sentnum))][key] = pb_instance
+            for token_pos in token_positions:
+                position_dict[(file_num, str(sentnum))][token_pos] = pb_instance
+
+        return dict(instance_dict), dict(position_dict)
+
+    @classmethod
+    def leaf_to_token_index(cls, tree):
+        """
+        Returns {leaf index: token index} for a PTB tree. Propbank pointers
+        count every leaf, but the tokens of a sentence (as seen by the parser)
+        don't include empty elements (-NONE-: traces, PRO, etc)
+        """
+        token_index = {}
+        for leaf_idx, (word, tag) in enumerate(tree.pos()):
+            if tag != '-NONE-':
+                token_index[leaf_idx] = len(token_index)
+        return token_index
+
+    @classmethod
+    def pointer_to_word(cls, pointer, tree, leaf_positions=None):
         """
         Given a PropbankPointer (basically a special tree address), returns the 
-        word at that location in the given tree
+        word at that location in the given tree. If the tree's leaf positions
+        (tree.treepositions('leaves')) are given, they are used instead of
+        walking the tree
         """
-        treepos = pointer.treepos(tree)
+        treepos = Propbank.pointer_treepos(pointer, tree, leaf_positions)
         word = tree[treepos].leaves()[0]
         return word
 
+    @classmethod
+    def pointer_treepos(cls, pointer, tree, leaf_positions=None):
+        """Returns the tree position of a (simple) PropbankTreePointer"""
+        if leaf_positions is None:
+            return pointer.treepos(tree)
+        leaf_pos = leaf_positions[pointer.wordnum]
+        return leaf_pos[:len(leaf_pos) - pointer.height - 1]
+
+    @classmethod
+    def pointer_spans(cls, pointer, tree, token_index, leaf_positions=None):
+        """
+        Returns the token spans [(start, end)] covered by a PropbankPointer,
+        where end is exclusive and tokens don't count empty elements (see
+        leaf_to_token_index). Split and chain pointers give one span per
+        piece; pieces that are only empty elements (traces) give none
+        """
+        if not isinstance(pointer, PropbankTreePointer):
+            return [span for p in pointer.pieces for span in cls.pointer_spans(p, tree, token_index, leaf_positions)]
+
+        treepos = cls.pointer_treepos(pointer, tree, leaf_positions)
+        num_leaves = len(tree[treepos].leaves())
+        tokens = [token_index[i] for i in range(pointer.wordnum, pointer.wordnum + num_leaves) if i in token_index]
+        if len(tokens) == 0:
+            return []
+        return [(min(tokens), max(tokens) + 1)]
+
+    @classmethod
+    def argument_spans(cls, arguments, tree, token_index, leaf_positions=None):
+        """Returns [(argid, [(start, end)])] for the (pointer, argid) arguments of an instance"""
+        return [(argid, cls.pointer_spans(pointer, tree, token_index, leaf_positions)) for pointer, argid in arguments]
+
     @classmethod
     def load(cls):
         """Returns Propbank from cache if exists, else loads"""
@@ -95,36 +263,205 @@ class Propbank(object):
         if os.path.exists(pickle_filename):
             return pickle.load(open(pickle_filename, 'rb'))
         else:
-            propbank = Propbank.from_nltk()
+            propbank = Propbank.from_files()
             pickle.dump(propbank, open(pickle_filename, 'wb'))
             return propbank
 
+class PropbankStore(object):
+    """
+    Disk-backed replacement for Propbank with the same lookup interface.
+    Instances and roles live in an SQLite file and are only unpickled when
+    asked for, with an LRU of recently used sentences/roles in front, so
+    memory and startup time don't grow with the size of Propbank
+    """
+    CACHE_SIZE = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.connection_pid = None
+        self.sentence_cache = OrderedDict() # {(file_num, sent_num): ({word: instance}, {token_pos: instance})}
+        self.role_cache = OrderedDict() # {roleset_id: Role}
+
+    def __getstate__(self):
+        # Connections can't be pickled (or shared with worker processes)
+        state = dict(self.__dict__)
+        state['connection'] = None
+        state['connection_pid'] = None
+        return state
+
+    def cursor(self):
+        """Returns a cursor on the (read-only) database, reconnecting in new processes"""
+        if self.connection is None or self.connection_pid != os.getpid():
+            # as_uri quotes characters that mean something in a URI (?, #, %)
+            uri = pathlib.Path(os.path.abspath(self.filename)).as_uri() + '?mode=ro'
+            self.connection = sqlite3.connect(uri, uri=True)
+            self.connection_pid = os.getpid()
+        return self.connection.cursor()
+
+    def get_role(self, roleset_id):
+        """Returns role given roleset_id"""
+        if roleset_id in self.role_cache:
+            self.role_cache.move_to_end(roleset_id)
+            return self.role_cache[roleset_id]
+
+        row = self.cursor().execute("SELECT data FROM roles WHERE roleset_id = ?", (roleset_id,)).fetchone()
+        if row is None:
+            raise KeyError(roleset_id)
+        role = pickle.loads(row[0])
+        self.add_to_cache(self.role_cache, roleset_id, role)
+        return role
+
+    def get_sentence_instances(self, file_num, sent_num):
+        """
+        Returns ({word: PropbankInstance}, {token_pos: PropbankInstance}) for
+        every predicate in a sentence
+        """
+        key = (file_num, sent_num)
+        if key in self.sentence_cache:
+            self.sentence_cache.move_to_end(key)
+            return self.sentence_cache[key]
+
+        rows = self.cursor().execute(
+            "SELECT data FROM instances WHERE file_num = ? AND sent_num = ?", key).fetchall()
+        by_word, by_position = {}, {}
+        for row in rows:
+            instance = pickle.loads(row[0])
+            by_word[instance.word] = instance
+            for token_pos in getattr(instance, 'token_positions', []):
+                by_position[token_pos] = instance
+        self.add_to_cache(self.sentence_cache, key, (by_word, by_position))
+        return by_word, by_position
+
+    def get_instance(self, file_num, sent_num, word, token_pos=None):
+        """See Propbank.get_instance"""
+        by_word, by_position = self.get_sentence_instances(file_num, sent_num)
+        if token_pos is not None and len(by_position) > 0:
+            instance = by_position.get(token_pos)
+            return instance if instance is not None and instance.has_word(word) else None
+        return by_word.get(word)
+
+    def get_instances(self, file_num, sent_num):
+        """See Propbank.get_instances"""
+        by_word, by_position = self.get_sentence_instances(file_num, sent_num)
+        return PropbankInstance.unique(list(by_word.values()) + list(by_position.values()))
+
+    def get_vn_classes(self, file_num, sent_num, word, token_pos=None):
+        instance = self.get_instance(file_num, sent_num, word, token_pos=token_pos)
+        if instance is None:
+            return []
+        roleset_id = instance.roleset_id
+        role = self.get_role(roleset_id)
+        return role.vn_classes
+
+    def add_to_cache(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.CACHE_SIZE:
+            cache.popitem(last=False)
+
+    @classmethod
+    def word_key(cls, word):
+        """Returns the text column value for a predicate (split predicates are tuples)"""
+        if isinstance(word, tuple):
+            return "\t".join(word)
+        return word
+
+    @classmethod
+    def build(cls, propbank, filename):
+        """Writes every instance and role of an in-memory Propbank to a new SQLite file"""
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE roles (roleset_id TEXT PRIMARY KEY, data BLOB)")
+        connection.execute("CREATE TABLE instances (file_num TEXT, sent_num TEXT, word TEXT, data BLOB)")
+        connection.execute("CREATE INDEX sentence_index ON instances (file_num, sent_num)")
+        connection.executemany("INSERT INTO roles VALUES (?, ?)",
+            ((roleset_id, pickle.dumps(role)) for roleset_id, role in propbank.role_dict.items()))
+        # Instances of a repeated verb are only all in the position dict
+        instances = {}
+        for sentence_dict in [propbank.instance_dict, getattr(propbank, 'position_dict', {})]:
+            for sentence_instances in sentence_dict.values():
+                for instance in sentence_instances.values():
+                    instances[id(instance)] = instance
+        connection.executemany("INSERT INTO instances VALUES (?, ?, ?, ?)",
+            ((i.filenum, i.sentnum, cls.word_key(i.word), pickle.dumps(i)) for i in instances.values()))
+        connection.commit()
+        connection.close()
+        return PropbankStore(filename)
+
+    @classmethod
+    def load(cls, filename=DATA_DIR + 'propbank.sqlite'):
+        """Returns PropbankStore, building the database from Propbank.load() if necessary"""
+        if not os.path.exists(filename):
+            cls.build(Propbank.load(), filename)
+        return PropbankStore(filename)
+
 class PropbankInstance(object):
     """
     This is basically just a replica of the same class in nltk; however that
     class doesn't play nicely with pickle, and loading without pickle takes too long
     """
-    def __init__(self, fileid, filenum, sentnum, word, roleset_id, arguments):
+    def __init__(self, fileid, filenum, sentnum, word, roleset_id, arguments, token_positions=None, argument_spans=None):
+        if token_positions is None:
+            token_positions = []
+        if argument_spans is None:
+            argument_spans = []
         self.fileid = fileid
         self.filenum = filenum
         self.sentnum = sentnum
         self.word = word
         self.roleset_id = roleset_id
         self.arguments = arguments
+        # Positions of the predicate (every piece, for split predicates) among
+        # the sentence tokens, not counting empty elements
+        self.token_positions = token_positions
+        # [(argid, [(start, end)])], token spans of the arguments, same numbering
+        self.argument_spans = argument_spans
+
+    def has_word(self, word):
+        """Returns True if word is the predicate (or one of its pieces)"""
+        if isinstance(self.word, tuple):
+            return word in self.word
+        return word == self.word
 
     def numbered_args(self):
         return [(ptr, arg) for ptr, arg in self.arguments if arg[-1].isdigit()]
 
+    @classmethod
+    def unique(cls, instances):
+        """Returns instances without repeats, in order (split predicates are indexed more than once)"""
+        seen = set()
+        unique = []
+        for instance in instances:
+            if id(instance) not in seen:
+                seen.add(id(instance))
+                unique.append(instance)
+        return unique
+
 class Role(object):
     """Represents a verb frame in Propbank"""
-    def __init__(self, roleset_id, name, vncls_str):
+    def __init__(self, roleset_id, name, vncls_str, themroles=None):
+        if themroles is None:
+            themroles = {}
         self.lemma = roleset_id.split(".")[0]
         self.roleset_id = roleset_id
         self.name = name
         self.vn_classes = vncls_str.split()
+        self.themroles = themroles # {ARG0: {agent}}, VerbNet thematic roles of each argument
+
+    def get_themroles(self, argid):
+        """Returns the (lowercase) VerbNet thematic roles argid maps to"""
+        # getattr b/c roles pickled before themroles were read don't have them
+        return getattr(self, 'themroles', {}).get(argid, set())
 
     @classmethod
     def fromxml(cls, xml):
         """Parses a role from the propbank xml file"""
         attrib = xml.attrib
-        return Role(attrib['id'], attrib['name'], attrib.get('vncls', ''))
+        themroles = {}
+        for role_xml in xml.findall("roles/role"):
+            argid = "ARG" + role_xml.attrib.get("n", "")
+            for vnrole in role_xml.findall("vnrole"):
+                themroles.setdefault(argid, set()).add(vnrole.attrib.get("vntheta", "").lower())
+        return Role(attrib['id'], attrib['name'], attrib.get('vncls', ''), themroles)
@@ -86,6 +86,24 @@ class Semantics(object):
         new_sem.quantification_dict.update(other.quantification_dict)
         return new_sem
 
+    def to_template(self):
+        """
+        Returns a json-serializable representation of the relations and
+        quantifiers, keeping variable attributes (arg type, event type, etc)
+        """
+        return {
+            "relations": [r.to_template() for r in self.relations],
+            "quantification": [[v.to_template(), q] for v, q in self.quantification_dict.items()],
+        }
+
+    @classmethod
+    def from_template(cls, template):
+        """Returns a new Semantics object from the output of to_template"""
+        sem = Semantics([Relation.from_template(r) for r in template["relations"]])
+        for v, quant in template["quantification"]:
+            sem.set_quantification(Relation.arg_from_template(v), quant)
+        return sem
+
     def __str__(self):
         quant_str = ",".join("%s%s" % (v, k) for k,v in self.quantification_dict.items())
         if len(quant_str) > 0:
@@ -272,6 +290,9 @@ class Constant(object):
     def copy(self):
         return Constant(self.name)
 
+    def to_template(self):
+        return {"constant": self.name}
+
     def __eq__(self, o):
         return isinstance(o, Constant) and o.name == self.name
 
@@ -324,6 +345,22 @@ class Variable(object):
         new_var.missing = self.missing
         return new_var
 
+    def to_template(self):
+        return {
+            "name": self.name,
+            "orig_name": self.orig_name,
+            "arg_type": self.arg_type,
+            "event_type": self.event_type,
+            "missing": self.missing,
+        }
+
+    @classmethod
+    def from_template(cls, template):
+        new_var = Variable(template["name"], template["arg_type"], template["event_type"])
+        new_var.orig_name = template["orig_name"]
+        new_var.missing = template["missing"]
+        return new_var
+
     def __str__(self):
         #if self.event_type is not None:
         #    return "%s(%s)" % (str(self.event_type), str(self.name))
@@ -348,6 +385,10 @@ class CompoundVariable(Variable):
         self.second = self.second.apply_binding(rename_dict)
         return self
 
+    def to_template(self):
+        compound = "AND" if isinstance(self, AndVariable) else "OR"
+        return {"compound": compound, "first": self.first.to_template(), "second": self.second.to_template()}
+
     def flattened_variable_list(self):
         """Returns a list of simple variables contained in the CompoundVariable"""
         variable_list = []
@@ -398,6 +439,27 @@ class Relation(object):
         self.args = [a.apply_binding(rename_dict) for a in self.args]
         return self
 
+    def to_template(self):
+        return [self.name, [a.to_template() for a in self.args]]
+
+    @classmethod
+    def from_template(cls, template):
+        name, args = template
+        return Relation(name, [cls.arg_from_template(a) for a in args])
+
+    @classmethod
+    def arg_from_template(cls, template):
+        """Returns the Constant, Variable or CompoundVariable given by template"""
+        if "constant" in template:
+            return Constant(template["constant"])
+        elif "compound" in template:
+            first = cls.arg_from_template(template["first"])
+            second = cls.arg_from_template(template["second"])
+            if template["compound"] == "AND":
+                return AndVariable(first, second)
+            return OrVariable(first, second)
+        return Variable.from_template(template)
+
     def event(self):
         """Returns the first event variable, if exists"""
         for v in self.variables():
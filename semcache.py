@@ -0,0 +1,128 @@
+import hashlib, json, os, tempfile
+
+from derivation import SkipFailedAttachments
+from semserializer import SemanticsSerializer
+from vnet_constants import DATA_DIR
+
+class SemanticsCache(object):
+    """
+    On-disk, content-addressed cache of the full semantics of sentences.
+    Entries are keyed by the hash of a derivation's canonical string (see
+    DerivationTree.canonical_string) together with a fingerprint of every
+    resource the semantics depend on, so re-runs only compute sentences
+    whose derivation or resources changed, and identical derivations in
+    different files are computed once.
+
+    Each entry is a small JSON file under dirname/<first 2 hex digits>/,
+    written to a temp file and renamed into place, so any number of
+    processes (or hosts sharing the directory) can use the same cache.
+    Entries look like {"semantics": "..."} or, for sentences that can't be
+    composed, {"error": "NotImplementedError"}
+    """
+    # What Grammar, VerbNet, XTAGMapper and Propbank (or PropbankStore) load
+    # actually read; the pickles are rebuilt from the XML when that changes
+    RESOURCE_FILES = ['xtag.pickle', 'verbnet.pickle', 'verbnet_xtag_mapping.txt', 'propbank.pickle', 'propbank.sqlite']
+    SOURCE_FILES = ['derivation.py', 'grammar.py', 'lemmatizer.py', 'propbank.py', 'semantics.py', 'semgrammar.py',
+        'semparser.py', 'semserializer.py', 'tagtree.py', 'verbnet.py']
+    # Errors that make a sentence fail rather than the run, AssertionError
+    # being a child with no (or several) matching attachment sites
+    FAILED_ERRORS = SkipFailedAttachments.SKIPPED_ERRORS + (AssertionError,)
+
+    def __init__(self, dirname, resource_hash):
+        self.dirname = dirname
+        self.resource_hash = resource_hash # See fingerprint
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, deriv_tree, semgrammar):
+        """Returns the hex key of deriv_tree's entry"""
+        canonical = deriv_tree.canonical_string(semgrammar)
+        return hashlib.sha1((self.resource_hash + "\n" + canonical).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.json')
+
+    def get(self, key):
+        """Returns the cached record for key, or None"""
+        try:
+            with open(self.path(key), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            # Missing, or half written by a process that was killed
+            return None
+
+    def put(self, key, record):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def get_record(self, deriv_tree, semgrammar, policy=None, stats=None):
+        """
+        Returns the record of deriv_tree, composing and caching it if needed.
+        Records don't keep what went wrong composing them, so with stats (an
+        Instrumentation) the sentence is always composed, and cached again
+        """
+        key = self.key(deriv_tree, semgrammar)
+        record = self.get(key) if stats is None else None
+        if record is not None:
+            self.hits += 1
+            return record
+
+        self.misses += 1
+        record = self.compute(deriv_tree, semgrammar, policy=policy, stats=stats)
+        self.put(key, record)
+        return record
+
+    def get_semantics(self, deriv_tree, semgrammar, policy=None):
+        """Returns the Semantics of deriv_tree, or None if it can't be composed"""
+        record = self.get_record(deriv_tree, semgrammar, policy=policy)
+        if "semantics" not in record:
+            return None
+        return SemanticsSerializer.from_string(record["semantics"])
+
+    @classmethod
+    def compute(cls, deriv_tree, semgrammar, policy=None, stats=None):
+        """Returns the (uncached) record of deriv_tree"""
+        try:
+            semtree = deriv_tree.get_parse_tree(semgrammar, policy=policy, stats=stats)
+        except cls.FAILED_ERRORS as e:
+            return {"error": type(e).__name__}
+        return {"semantics": SemanticsSerializer.to_string(semtree.full_semantics())}
+
+    @classmethod
+    def fingerprint(cls, filenames):
+        """
+        Returns a hash of the contents of filenames (missing files count as
+        empty, so the fingerprint changes when they appear)
+        """
+        fingerprint = hashlib.sha1()
+        for filename in filenames:
+            fingerprint.update(("%s\n" % os.path.basename(filename)).encode('utf-8'))
+            if not os.path.exists(filename):
+                continue
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    fingerprint.update(chunk)
+        return fingerprint.hexdigest()
+
+    @classmethod
+    def resource_filenames(cls, data_dir=DATA_DIR):
+        """
+        Returns the files whose contents decide the semantics of a
+        derivation: the grammar, VerbNet, the mapper and Propbank, plus the
+        code that holds the annotation tables and does the composing
+        """
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        return ([os.path.join(data_dir, f) for f in cls.RESOURCE_FILES] +
+                [os.path.join(source_dir, f) for f in cls.SOURCE_FILES])
+
+    @classmethod
+    def load(cls, dirname=DATA_DIR + 'semantics_cache', data_dir=DATA_DIR):
+        """
+        Returns the cache in dirname, for the resources currently in data_dir.
+        Load the SemTreeGrammar first, as loading it may write the pickles
+        """
+        return cls(dirname, cls.fingerprint(cls.resource_filenames(data_dir)))
@@ -1,12 +1,13 @@
-import inflection, traceback, json
+import traceback, json
 
 from collections import defaultdict
 
 from grammar import Grammar
 from verbnet import VerbNet, XTAGMapper
-from propbank import Propbank
-from derivation import DerivationTree
-from semantics import Semantics, VariableFactory, Constant, Relation, Token, Variable, VariableBinding
+from propbank import PropbankStore
+from derivation import DerivationTree, CompositionMemo
+from lemmatizer import AnchorLemmatizer
+from semantics import Semantics, VariableFactory, Relation, Token, Variable
 from tagtree import SemTree
 from semparser import SemanticParser, VariableParser
 from vnet_constants import DATA_DIR
@@ -22,16 +23,160 @@ class SemTreeGrammar(object):
         relative clauses
     """
 
+    # Families of verb trees whose semantics don't come from VerbNet (see get_nonverb_tree_family)
+    NONVERB_FAMILIES = ['Ts0N1', 'Tnx0Pnx1', 'Tnx0N1', 'Tnx0BEnx1', 'Tnx0Ax1', 'Ts0Ax1', 'Ts0Pnx1']
+
+    # Semantics of non-verb trees, either for any anchor (by tree name) or
+    # for a particular one (by (tree name, anchor)), see get_nonverb_semtree:
+    # {node label: (anchor -> semantics string, variable string)}
+    NONVERB_SEMANTICS = {
+        "alphaNXN": {
+            "NP": (lambda a: "", "x1"),
+            "N": (lambda a: "ISA(x1, %s)" % a.upper(), "x1"),
+        },
+        "betaAn": {
+            "N_r": (lambda a: "ISA(x1, %s)" % a.upper(), "x1"),
+            "N_f": (lambda a: "", "x1"),
+        },
+        "betaNn": {
+            "N_r": (lambda a: "ISA(x1, %s)" % a.upper(), "x1"),
+            "N_f": (lambda a: "", "x1"),
+        },
+        ("betaDnx", "a"): {
+            "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
+            "NP_f": (lambda a: "", "x1"),
+        },
+        ("betaDnx", "an"): {
+            "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
+            "NP_f": (lambda a: "", "x1"),
+        },
+        ("betaDnx", "the"): {
+            "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
+            "NP_f": (lambda a: "", "x1"),
+        },
+        ("betaDnx", "one"): {
+            "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
+            "NP_f": (lambda a: "", "x1"),
+        },
+        "betaVvx": {
+            "VP_r": (lambda a: "", "x1"),
+            "VP": (lambda a: "", "x1"),
+        },
+        "betanxPnx": {
+            "NP_r": (lambda a: "%s(x1, y1)" % a, "x1"),
+            "NP": (lambda a: "", "y1"),
+            "NP_f": (lambda a: "", "x1"),
+        },
+        "betavxPnx": {
+            "VP_r": (lambda a: "%s(x1, y1)" % a, "x1"),
+            "NP": (lambda a: "", "y1"),
+            "VP": (lambda a: "", "x1"),
+        },
+        "betasPUs": {
+            "S_r": (lambda a: "", "AND(x1,y1)"),
+            "S_f": (lambda a: "", "x1"),
+            "S_1": (lambda a: "", "y1"),
+        },
+        "betaARBvx": {
+            "VP": (lambda a: "", "x1"),
+            "VP_r": (lambda a: "%s(x1)" % a, "x1"),
+        },
+        "betanxPUnx": {
+            "NP_f": (lambda a: "", "x1"),
+            "NP_r": (lambda a: "equal(x1,y1)", "x1"),
+            "NP": (lambda a: "", "y1"),
+        },
+        "betaPUs": {
+            "S_r": (lambda a: "", "x1"),
+            "S": (lambda a: "", "x1"),
+        },
+        "betaVs": {
+            "S_r": (lambda a: "", "x1"),
+            "S": (lambda a: "", "x1"),
+        },
+        "betanx1CONJnx2": {
+            "NP": (lambda a: "", "AND(x1,y1)"),
+            "NP_1": (lambda a: "", "x1"),
+            "NP_2": (lambda a: "", "y1"),
+        },
+        "betanxGnx": {
+            "NP_r": (lambda a: "EXISTS(x1)|belongs_to(x1,y1)", "x1"),
+            "NP_f": (lambda a: "", "x1"),
+            "NP": (lambda a: "", "y1"),
+        },
+        "betavxPs": {
+            "VP_r": (lambda a: "", "x1"),
+            "VP_f": (lambda a: "", "x1"),
+            "PP": (lambda a: "%s(x1, y1)" % a, "y1"),
+            "S": (lambda a: "", "y1"),
+        },
+        "betas1CONJs2": {
+            "S": (lambda a: "", "AND(x1,y1)"),
+            "S_1": (lambda a: "", "x1"),
+            "S_2": (lambda a: "", "y1"),
+        },
+        "betaARBs": {
+            "S": (lambda a: "", "x1"),
+            "S_r": (lambda a: "%s(x1)" % a, "x1"),
+        },
+        "betaCONJs": {
+            "S_c": (lambda a: "", "x1"),
+            "S_r": (lambda a: "", "x1"),
+        },
+    }
+
     def __init__(self, grammar, verbnet, xtag_mapper, propbank):
         self.verbnet = verbnet
         self.grammar = grammar
         self.xtag_mapper = xtag_mapper
         self.propbank = propbank
         self.sem_trees = {}
+        self.composition_memo = CompositionMemo()
+        self.annotated_tree_sets = {} # {(tree_families, tree_set): tree names}, see annotated_trees
+        self.lemmatizer = AnchorLemmatizer(verbnet.lemma_to_classes)
+        if not verbnet.has_family_index(xtag_mapper):
+            verbnet.build_family_index(xtag_mapper)
 
-    def get_semtree(self, tree_name, anchor, lemma=None, pb_instance=None):
-        if (tree_name, anchor) in self.sem_trees:
-            return self.sem_trees[(tree_name, anchor)].copy()
+    def annotated_trees(self, tree_families, tree_set):
+        """
+        Returns the names of the grammar's trees that have semantics by the
+        test of prune_deriv_tree and have_semantics (see
+        DerivationTree.tree_has_semantics), computed once per (tree_families,
+        tree_set). The grammar's trees are looked at in place, without copying
+        """
+        key = (frozenset(tree_families), frozenset(tree_set))
+        # getattr b/c pickled grammars from before the index don't have it
+        if getattr(self, 'annotated_tree_sets', None) is None:
+            self.annotated_tree_sets = {}
+        if key not in self.annotated_tree_sets:
+            self.annotated_tree_sets[key] = frozenset(tree_name for tree_name in self.grammar.tree_dict
+                if DerivationTree.tree_has_semantics(self.grammar, tree_name, tree_families, tree_set))
+        return self.annotated_tree_sets[key]
+
+    def default_annotated_trees(self):
+        """
+        Returns (tree_families, tree_set) of the trees get_semtree can
+        annotate: the families mapped to VerbNet frames or in NONVERB_FAMILIES,
+        and the non-verb trees of NONVERB_SEMANTICS
+        """
+        tree_families = set(self.xtag_mapper.xtag_mapping.values()) | set(self.NONVERB_FAMILIES)
+        tree_set = set(k if isinstance(k, str) else k[0] for k in self.NONVERB_SEMANTICS)
+        return tree_families, tree_set
+
+    def get_semtree(self, tree_name, anchor, lemma=None, pb_instance=None, arguments=None):
+        """
+        Returns a copy of the semantically annotated tree_name anchored by
+        anchor. The frames of verb trees come from pb_instance's roleset if
+        given, preferring frames that give the roleset's thematic roles to
+        arguments, the ((location, argid),) filled in the derivation (see
+        ArgumentAlignment.child_arguments), else from lemma (or the anchor's lemma)
+        """
+        # The roleset and arguments pick the frames of verb trees, so two
+        # instances of the same verb only share a semtree if they share both
+        roleset_id = pb_instance.roleset_id if pb_instance is not None else None
+        key = (tree_name, anchor, roleset_id, lemma, arguments)
+        if key in self.sem_trees:
+            return self.sem_trees[key].copy()
 
         tree = self.grammar.get(tree_name)
         if len(tree.anchor_positions()) > 1:
@@ -39,26 +184,34 @@ class SemTreeGrammar(object):
             raise NotImplementedError
         elif not tree.belongs_to_verb_family():
             sem_tree = self.get_nonverb_semtree(tree_name, anchor)
-        elif tree.tree_family in ['Ts0N1', 'Tnx0Pnx1', 'Tnx0N1', 'Tnx0BEnx1', 'Tnx0Ax1', 'Ts0Ax1', 'Ts0Pnx1']:
+        elif tree.tree_family in self.NONVERB_FAMILIES:
             verb_trees = self.get_nonverb_tree_family(tree_name, anchor)
             sem_tree = verb_trees[0]
         elif pb_instance is not None:
-            verb_trees = self.get_semtrees_from_pb_instance(tree_name, anchor, pb_instance)
+            verb_trees = self.get_semtrees_from_pb_instance(tree_name, anchor, pb_instance, arguments)
             sem_tree = verb_trees[0] # Don't have any better way to choose at this point 
-        elif lemma is not None:
+        else:
+            # Without a propbank instance, get frames from the anchor's lemma
+            if lemma is None:
+                lemma = self.lemmatizer.lemmatize(anchor, 'v')
+            if lemma is None:
+                #print("NotImplementedError", tree.tree_family)#, tree_name, anchor, lemma, pb_instance)
+                raise NotImplementedError
             verb_trees = self.get_semtrees_from_lemma(tree_name, anchor, lemma)
             sem_tree = verb_trees[0] # Don't have any better way to choose at this point 
-        else:
-            #print("NotImplementedError", tree.tree_family)#, tree_name, anchor, lemma, pb_instance)
-            raise NotImplementedError
 
-        self.sem_trees[(tree_name, anchor)] = sem_tree
+        self.sem_trees[key] = sem_tree
         return sem_tree.copy()
 
     def get_semtrees_from_lemma(self, tree_name, anchor, lemma):
-        frames = self.verbnet.get_frames(lemma)
+        tree_family = self.grammar.get(tree_name, copy=False).tree_family
+        frames = self.verbnet.get_frames_from_family(lemma, tree_family)
+        if len(frames) == 0:
+            # No frame maps to this family, so try aligning every frame
+            frames = self.verbnet.get_frames(lemma)
         semtrees = []
         for f in frames:
+            f = self.verbnet.get_lexicalized_frame(f, lemma)
             tree = self.grammar.get(tree_name, copy=True)
             semtrees.append(self.add_semantics(tree, anchor, f.np_var_order, f.sem_dict))
         #semtrees = [self.add_semantics(tree_name, lemma, f.sem_dict) for f in frames]
@@ -124,28 +277,50 @@ class SemTreeGrammar(object):
 
         return [self.add_semantics(tree, anchor, np_var_order, sem_dict)]
 
-    def get_semtrees_from_pb_instance(self, tree_name, anchor, pb_instance):
-        vn_classes = self.propbank.get_vn_classes(pb_instance.filenum, pb_instance.sentnum, pb_instance.word)
+    def get_semtrees_from_pb_instance(self, tree_name, anchor, pb_instance, arguments=None):
+        roleset_id = pb_instance.roleset_id
+        role = self.propbank.get_role(roleset_id)
+        vn_classes = role.vn_classes
+
+        # Only frames from the tree's family can match, so skip the rest
+        # before paying for a tree copy
+        tree_family = self.grammar.get(tree_name, copy=False).tree_family
         frames = []
         for vn_class in vn_classes:
-            frames += self.verbnet.get_frames_from_class(vn_class)
-
+            frames += self.verbnet.get_frames_from_class_family(vn_class, tree_family)
         semtrees = []
         for frame in frames:
             # Requires a new copy every time
             tree = self.grammar.get(tree_name, copy=True)
 
-            # Skip frames from different family
-            xtag_family = self.xtag_mapper.get_xtag_family(frame.primary, frame.secondary) 
-            if xtag_family is None or xtag_family != tree.tree_family:
-                continue
-
             # Return tree with semantics
+            frame = self.verbnet.get_lexicalized_frame(frame, role.lemma)
             semtree = self.add_semantics(tree, anchor, frame.np_var_order, frame.sem_dict)
-            semtrees.append(semtree)
+            if semtree is not None:
+                semtrees.append((semtree, frame.sem_dict))
 
-        semtrees = [s for s in semtrees if s is not None]
-        return semtrees
+        if arguments:
+            # Frames whose roles agree with the most Propbank arguments come first
+            semtrees.sort(key=lambda s: -self.role_matches(s[0], s[1], role, arguments))
+        return [semtree for semtree, sem_dict in semtrees]
+
+    def role_matches(self, semtree, sem_dict, role, arguments):
+        """
+        Returns how many of arguments ((location, argid),) fill a subst node
+        of semtree whose thematic role (from the frame's sem_dict) is one
+        that role maps argid to
+        """
+        matches = 0
+        for location, argid in arguments:
+            themroles = role.get_themroles(argid)
+            for node in semtree.subst_nodes():
+                if node.original_label() != location or node.sem_var is None:
+                    continue
+                relations = sem_dict[node.sem_var.name].relations if node.sem_var.name in sem_dict else []
+                if any(r.name.lower() in themroles for r in relations):
+                    matches += 1
+                    break
+        return matches
 
     def add_semantics(self, tree, anchor, np_var_order, sem_dict):
         """
@@ -183,13 +358,11 @@ class SemTreeGrammar(object):
 
         tree = SemTree.convert(tree)
 
-        # Map event semantics to root
+        # Map event semantics to root. sem_dict may belong to a shared
+        # (lexicalized) frame, so it's only read from: concat makes new
+        # Semantics, and get_semtree only hands out copies of this tree
         tree.semantics = sem_dict["Event"]
 
-        # Replace anchor specific constants
-        anchor_rename = VariableBinding({Constant("__ANCHOR__"): Constant(anchor.upper())})
-        tree.semantics.apply_binding(anchor_rename)
-
         events = [v for v in tree.semantics.variables() if v.arg_type == "Event"]
         if len(events) == 0:
             import code; code.interact(local=locals())
@@ -202,7 +375,6 @@ class SemTreeGrammar(object):
                 #subst_node.semantics = sem_dict[np_var.name]
                 tree.semantics = tree.semantics.concat(sem_dict[np_var.name])
                 subst_node.sem_var = np_var
-                tree.semantics.apply_binding(anchor_rename) # replace anchor specific constants
 
         # Check for PRO trees
         # Unclear to me how to handle the semantics here
@@ -230,13 +402,7 @@ class SemTreeGrammar(object):
 
     def get_tree_families(self, lemma):
         """Returns all tree families that can be associated with a lemma"""
-        tree_families = set()
-        frames = self.verbnet.get_frames(lemma)
-        for f in frames:
-            xtag_family = self.xtag_mapper.get_xtag_family(f.primary, f.secondary) 
-            if xtag_family is not None:
-                tree_families.add(xtag_family)
-        return tree_families
+        return self.verbnet.get_tree_families(lemma)
 
     def get_nonverb_semtree(self, tree_name, anchor):
         """
@@ -256,103 +422,7 @@ class SemTreeGrammar(object):
             v = VariableFactory.get_var()
         '''
 
-        sem_map = {
-            "alphaNXN": {
-                "NP": (lambda a: "", "x1"),
-                "N": (lambda a: "ISA(x1, %s)" % a.upper(), "x1"),
-            },
-            "betaAn": {
-                "N_r": (lambda a: "ISA(x1, %s)" % a.upper(), "x1"),
-                "N_f": (lambda a: "", "x1"),
-            },
-            "betaNn": {
-                "N_r": (lambda a: "ISA(x1, %s)" % a.upper(), "x1"),
-                "N_f": (lambda a: "", "x1"),
-            },
-            ("betaDnx", "a"): {
-                "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
-                "NP_f": (lambda a: "", "x1"),
-            },
-            ("betaDnx", "an"): {
-                "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
-                "NP_f": (lambda a: "", "x1"),
-            },
-            ("betaDnx", "the"): {
-                "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
-                "NP_f": (lambda a: "", "x1"),
-            },
-            ("betaDnx", "one"): {
-                "NP_r": (lambda a: "EXISTS(x1)|", "x1"),
-                "NP_f": (lambda a: "", "x1"),
-            },
-            "betaVvx": {
-                "VP_r": (lambda a: "", "x1"),
-                "VP": (lambda a: "", "x1"),
-            },
-            "betanxPnx": {
-                "NP_r": (lambda a: "%s(x1, y1)" % a, "x1"),
-                "NP": (lambda a: "", "y1"),
-                "NP_f": (lambda a: "", "x1"),
-            },
-            "betavxPnx": {
-                "VP_r": (lambda a: "%s(x1, y1)" % a, "x1"),
-                "NP": (lambda a: "", "y1"),
-                "VP": (lambda a: "", "x1"),
-            },
-            "betasPUs": {
-                "S_r": (lambda a: "", "AND(x1,y1)"),
-                "S_f": (lambda a: "", "x1"),
-                "S_1": (lambda a: "", "y1"),
-            },
-            "betaARBvx": {
-                "VP": (lambda a: "", "x1"),
-                "VP_r": (lambda a: "%s(x1)" % a, "x1"),
-            },
-            "betanxPUnx": {
-                "NP_f": (lambda a: "", "x1"),
-                "NP_r": (lambda a: "equal(x1,y1)", "x1"),
-                "NP": (lambda a: "", "y1"),
-            },
-            "betaPUs": {
-                "S_r": (lambda a: "", "x1"),
-                "S": (lambda a: "", "x1"),
-            },
-            "betaVs": {
-                "S_r": (lambda a: "", "x1"),
-                "S": (lambda a: "", "x1"),
-            },
-            "betanx1CONJnx2": {
-                "NP": (lambda a: "", "AND(x1,y1)"),
-                "NP_1": (lambda a: "", "x1"),
-                "NP_2": (lambda a: "", "y1"),
-            },
-            "betanxGnx": {
-                "NP_r": (lambda a: "EXISTS(x1)|belongs_to(x1,y1)", "x1"),
-                "NP_f": (lambda a: "", "x1"),
-                "NP": (lambda a: "", "y1"),
-            },
-            "betavxPs": {
-                "VP_r": (lambda a: "", "x1"),
-                "VP_f": (lambda a: "", "x1"),
-                "PP": (lambda a: "%s(x1, y1)" % a, "y1"),
-                "S": (lambda a: "", "y1"),
-            },
-            "betas1CONJs2": {
-                "S": (lambda a: "", "AND(x1,y1)"),
-                "S_1": (lambda a: "", "x1"),
-                "S_2": (lambda a: "", "y1"),
-            },
-            "betaARBs": {
-                "S": (lambda a: "", "x1"),
-                "S_r": (lambda a: "%s(x1)" % a, "x1"),
-            },
-            "betaCONJs": {
-                "S_c": (lambda a: "", "x1"),
-                "S_r": (lambda a: "", "x1"),
-            },
-        }
-
-
+        sem_map = SemTreeGrammar.NONVERB_SEMANTICS
         if (tree_name, anchor) in sem_map:
             key = (tree_name, anchor)
         elif tree_name in sem_map:
@@ -371,12 +441,99 @@ class SemTreeGrammar(object):
 
         return tree
 
+    @classmethod
+    def load(cls):
+        """Returns SemTreeGrammar over the cached grammar, mapper, VerbNet and Propbank"""
+        g = Grammar.load()
+        mapper = XTAGMapper.load()
+        vnet = VerbNet.load(xtag_mapper=mapper)
+        propbank = PropbankStore.load()
+        return SemTreeGrammar(g, vnet, mapper, propbank)
+
+class CoverageReport(object):
+    """
+    Corpus-wide coverage of a set of annotated trees, computed in a single
+    pass over the derivations without copying any tree. A tree is annotated
+    by the same test prune_deriv_tree uses: its family is in tree_families
+    or it's in tree_set (see SemTreeGrammar.annotated_trees). Reports:
+        per tree and per family: occurrences, and how many are annotated
+        per sentence: covered (every tree annotated), prunable (the root is
+            annotated, so prune_deriv_tree keeps part of it) or lost
+        the fraction of derivation nodes that pruning keeps
+    """
+
+    def __init__(self, annotated_trees):
+        self.annotated_trees = annotated_trees # Names of the annotated trees
+        self.tree_counts = defaultdict(lambda: [0, 0]) # {tree_name: [count, annotated count]}
+        self.family_counts = defaultdict(lambda: [0, 0]) # {tree_family: [count, annotated count]}
+        self.sentences = 0
+        self.covered = 0
+        self.prunable = 0
+        self.lost = 0
+        self.nodes = 0
+        self.kept_nodes = 0
+
+    def add(self, deriv_tree, grammar):
+        """Returns self after counting deriv_tree"""
+        covered = True
+        stack = [(deriv_tree, True)] # (node, parent kept by pruning)
+        while len(stack) > 0:
+            node, parent_kept = stack.pop()
+            tree = grammar.get(node.tree_name, copy=False)
+            annotated = node.tree_name in self.annotated_trees
+            family = tree.tree_family if tree is not None else None
+
+            self.tree_counts[node.tree_name][0] += 1
+            self.family_counts[family][0] += 1
+            if annotated:
+                self.tree_counts[node.tree_name][1] += 1
+                self.family_counts[family][1] += 1
+            covered = covered and annotated
+
+            kept = parent_kept and annotated
+            self.nodes += 1
+            if kept:
+                self.kept_nodes += 1
+            stack.extend((c, kept) for c in node)
+
+        self.sentences += 1
+        if covered:
+            self.covered += 1
+        elif deriv_tree.tree_name in self.annotated_trees:
+            self.prunable += 1
+        else:
+            self.lost += 1
+        return self
+
+    @classmethod
+    def from_derivations(cls, deriv_trees, semgrammar, tree_families=None, tree_set=()):
+        """
+        Returns the report of an iterable of derivation trees (i.e.
+        DerivationTree.stream) for the given annotated trees, by default the
+        ones get_semtree can annotate (see default_annotated_trees)
+        """
+        if tree_families is None:
+            tree_families, tree_set = semgrammar.default_annotated_trees()
+        report = cls(semgrammar.annotated_trees(tree_families, tree_set))
+        for deriv_tree in deriv_trees:
+            report.add(deriv_tree, semgrammar.grammar)
+        return report
+
+    def to_dict(self):
+        sentences = max(self.sentences, 1)
+        return {
+            "sentences": self.sentences,
+            "covered_fraction": float(self.covered) / sentences,
+            "prunable_fraction": float(self.prunable) / sentences,
+            "lost_fraction": float(self.lost) / sentences,
+            "kept_node_fraction": float(self.kept_nodes) / max(self.nodes, 1),
+            "trees": {t: {"count": c, "annotated": a} for t, (c, a) in self.tree_counts.items()},
+            "families": {str(f): {"count": c, "annotated": a} for f, (c, a) in self.family_counts.items()},
+        }
+
 if __name__ == '__main__':
-    g = Grammar.load()
-    vnet = VerbNet.load()
-    mapper = XTAGMapper.load()
-    propbank = Propbank.load()
-    s = SemTreeGrammar(g, vnet, mapper, propbank)
+    s = SemTreeGrammar.load()
+    g, mapper = s.grammar, s.xtag_mapper
 
     jump = s.get_semtree('alphanx0Vnx1', 'jumped', lemma='run')
     tree_families = set(mapper.xtag_mapping.values())
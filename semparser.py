@@ -1,112 +1,169 @@
+import re
+
 from semantics import Semantics, Relation, Variable, Constant, Token, AndVariable, OrVariable
 
-class SemanticParser(object):
+class SemanticTokenizer(object):
+    """
+    Splits a semantics string into a flat list of tokens in a single pass.
+    Punctuation ("(", ")", ",", "|" and the "^" conjunction used by
+    str(Semantics)) are individual tokens; everything else is a name.
+    Spaces are dropped before tokenizing, so "MR. VINKEN" becomes "MR.VINKEN"
+    """
+    TOKEN_RE = re.compile(r"[(),|^]|[^(),|^]+")
+
     @classmethod
-    def parse(cls, string):
-        """Returns a Semantic object"""
-        string = string.replace(" ", "")
-        if "|" in string:
-            quant_str, string = string.split("|")
-        else:
-            quant_str, string = "", string
+    def tokenize(cls, string):
+        """Returns the list of tokens in string"""
+        return cls.TOKEN_RE.findall(string.replace(" ", ""))
+
+class TokenParser(object):
+    """
+    Recursive descent parser over the tokens given by SemanticTokenizer. Each
+    token is consumed exactly once, so parsing is linear in the length of the
+    input (only AND/OR nesting recurses)
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next token without consuming it (None at end of input)"""
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        """Consumes and returns the next token"""
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, token):
+        found = self.next()
+        assert found == token, "Expected %r at token %d, found %r" % (token, self.pos - 1, found)
+
+    def rest(self):
+        """Returns the unconsumed input as a string"""
+        return "".join(self.tokens[self.pos:])
+
+    def parse_semantics(self):
+        """Returns a Semantics object: [quantifiers |] relation, relation, ..."""
+        quantification_dict = {}
+        if "|" in self.tokens:
+            quantification_dict = self.parse_quantifiers()
 
-        # Parse conjuncted relations
         relations = []
-        while len(string) > 0:
-            relation, string = RelationParser.parse(string)
-            relations.append(relation)
-        sem = Semantics(relations)
+        while self.peek() is not None:
+            relations.append(self.parse_relation())
+            if self.peek() in (",", "^"):
+                self.pos += 1
 
-        # Parse any quantifiers
-        quantification_dict = QuantificationParser.parse(quant_str)
+        sem = Semantics(relations)
         sem.quantification_dict = quantification_dict
-
         return sem
 
-class QuantificationParser(object):
-    @classmethod
-    def parse(cls, string):
+    def parse_quantifiers(self):
+        """Returns quantification dict from "EXISTS(x),FORALL(y)", consuming the "|" if present"""
         quantification_dict = {}
-        quants = string.split(",")
-        for quant_str in quants:
-
-            if quant_str == "":
+        while self.peek() is not None and self.peek() != "|":
+            if self.peek() == ",":
+                self.pos += 1
                 continue
 
-            quant_str = quant_str.replace(")", "")
-            quant_str, var_str = quant_str.split("(")
+            quant_str = self.next()
+            self.expect("(")
+            var_str = self.next()
+            self.expect(")")
             if quant_str == "EXISTS":
                 quant = Token.EXISTS
             elif quant_str == "FORALL":
                 quant = Token.FORALL
             else:
-                assert False
-
+                assert False, "Unknown quantifier %r" % quant_str
             quantification_dict[Variable(var_str)] = quant
+
+        if self.peek() == "|":
+            self.pos += 1
         return quantification_dict
 
-class RelationParser(object):
+    def parse_relation(self):
+        """Returns a Relation from "name(arg, arg, ...)" """
+        relname = self.next()
+        self.expect("(")
+        args = []
+        while self.peek() != ")":
+            args.append(self.parse_arg())
+            if self.peek() == ",":
+                self.pos += 1
+        self.expect(")")
+        return Relation(relname, args)
+
+    def parse_arg(self):
+        """Returns a Constant, Variable, event-typed Variable or AND/OR variable"""
+        text = self.next()
+        if self.peek() != "(":
+            if text.isupper() or all(not c.isalpha() for c in text):
+                return Constant(text)
+            return Variable(text)
+
+        self.pos += 1 # Remove "("
+        if text in ("AND", "OR"):
+            first = self.parse_arg()
+            self.expect(",")
+            second = self.parse_arg()
+            self.expect(")")
+            if text == "AND":
+                return AndVariable(first, second)
+            return OrVariable(first, second)
+
+        # Handle during(e) cases
+        arg = Variable(self.next(), arg_type="Event", event_type=text)
+        self.expect(")")
+        return arg
+
+class SemanticParser(object):
     @classmethod
     def parse(cls, string):
-        relname, rest = string.split("(", 1)
-        args = []
-        while(rest[0] != ")"):
-            arg, rest = VariableParser.parse(rest)
-            args.append(arg)
+        """Returns a Semantic object"""
+        return TokenParser(SemanticTokenizer.tokenize(string)).parse_semantics()
 
-        rest = rest[1:] # Remove ")"
-        if len(rest) > 0 and rest[0] == ",":
-            rest = rest[1:] # Remove ","
+    @classmethod
+    def parse_many(cls, strings):
+        """
+        Returns a list of Semantic objects, one per string. Accepts any
+        iterable, e.g. the "semantics" fields of data/semantics.json
+        """
+        tokenize = SemanticTokenizer.tokenize
+        return [TokenParser(tokenize(string)).parse_semantics() for string in strings]
 
-        return Relation(relname, args), rest
+class QuantificationParser(object):
+    @classmethod
+    def parse(cls, string):
+        return TokenParser(SemanticTokenizer.tokenize(string)).parse_quantifiers()
 
-class VariableParser(object):
+class RelationParser(object):
     @classmethod
     def parse(cls, string):
-        # Want to slurp characters until a comma is encountered (new arg)
-        # or an unmatched closing paren encountered (end of list)
-        i = 0
-        paren_cnt = 0
-        while i < len(string):
-            if string[i] == "(":
-                paren_cnt += 1
-            elif string[i] == ")":
-                paren_cnt -= 1
-
-            if paren_cnt < 0 or string[i] == ",":
-                break
-            i += 1
-
-        # Handle end of string, paren, comma cases
-        if i == len(string):
-            arg_str = string
-            rest = ""
-        elif string[i] == ")":
-            arg_str = string[:i]
-            rest = string[i:]
-        else:
-            arg_str = string[:i]
-            rest = string[i+1:]
-
-        # Handle during(e) cases, constants, and variables,
-        if "(" in arg_str:
-            text, arg = arg_str.replace(")", "").split("(")
-            if text == "AND":
-                arg2, rest = VariableParser.parse(rest)
-                arg = AndVariable(Variable(arg), arg2)
-                rest = rest[1:] # remove closing paren
-            elif text == "OR":
-                arg2, rest = VariableParser.parse(rest)
-                arg = OrVariable(Variable(arg), arg2)
-                rest = rest[1:] # remove closing paren
-            else:
-                arg = Variable(arg, arg_type="Event", event_type=text)
-        elif arg_str.isupper() or all(not c.isalpha() for c in arg_str): #arg_str.isdigit():
-            arg = Constant(arg_str)
-        else:
-            arg = Variable(arg_str)
+        """Returns the first relation in string and the rest of the string"""
+        parser = TokenParser(SemanticTokenizer.tokenize(string))
+        relation = parser.parse_relation()
+        if parser.peek() == ",":
+            parser.pos += 1 # Remove ","
+        return relation, parser.rest()
 
-        return arg, rest
+class VariableParser(object):
+    @classmethod
+    def parse(cls, string):
+        """
+        Returns the first argument in string and the rest of the string. A
+        separating comma is consumed, a closing paren is left in the rest
+        """
+        parser = TokenParser(SemanticTokenizer.tokenize(string))
+        arg = parser.parse_arg()
+        if parser.peek() == ",":
+            parser.pos += 1 # Remove ","
+        return arg, parser.rest()
 
 def demo():
     semstr = "chased(during(e),x,y), Agent(e,x), Theme(e,y), ISA(x,CAT)"
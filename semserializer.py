@@ -0,0 +1,73 @@
+import json, sys
+
+from semantics import Semantics
+
+class SemanticsSerializer(object):
+    """
+    Converts Semantics objects to single line strings and back without
+    losing anything: the JSON of Semantics.to_template, which keeps
+    constants apart from variables (whatever their case or spacing) and the
+    arg and event types of every variable, so that i.e. Semantics.event()
+    and equiv() work on what's read back
+    """
+
+    @classmethod
+    def to_string(cls, sem):
+        """Returns the string representation of sem"""
+        return json.dumps(sem.to_template(), separators=(',', ':'), ensure_ascii=False)
+
+    @classmethod
+    def from_string(cls, string):
+        """Returns the Semantics object given by a string from to_string"""
+        return Semantics.from_template(json.loads(string))
+
+class SemanticsWriter(object):
+    """
+    Streams semantics to a file-like sink as JSON Lines, one record per
+    sentence. Each record is written as soon as it is given, so memory use
+    does not grow with the size of the run. Records look like:
+        {"sentence": "0001_0.parse", "semantics": "...", "tree": "...", "derivation": "..."}
+    where "tree" and "derivation" are only present if provided
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.count = 0
+
+    def write(self, sentence, sem, tree=None, derivation=None):
+        """Writes a single record for sentence. tree/derivation are nltk Trees"""
+        self.write_string(sentence, SemanticsSerializer.to_string(sem), tree=tree, derivation=derivation)
+
+    def write_string(self, sentence, sem_string, tree=None, derivation=None):
+        """Like write, for semantics already serialized with SemanticsSerializer"""
+        record = {"sentence": sentence, "semantics": sem_string}
+        if tree is not None:
+            record["tree"] = tree.pformat(margin=sys.maxsize)
+        if derivation is not None:
+            record["derivation"] = derivation.pformat(margin=sys.maxsize)
+        self.sink.write(json.dumps(record))
+        self.sink.write("\n")
+        self.count += 1
+
+    def write_semtree(self, sentence, semtree, derivation=None, include_tree=False):
+        """Writes the full semantics of semtree, optionally with its syntax"""
+        tree = semtree if include_tree else None
+        self.write(sentence, semtree.full_semantics(), tree=tree, derivation=derivation)
+
+class SemanticsReader(object):
+    """Reads back the JSON Lines written by SemanticsWriter, one record at a time"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def records(self):
+        """Yields the raw record dictionaries"""
+        for line in self.source:
+            line = line.strip()
+            if len(line) > 0:
+                yield json.loads(line)
+
+    def __iter__(self):
+        """Yields (sentence, Semantics) pairs"""
+        for record in self.records():
+            yield record["sentence"], SemanticsSerializer.from_string(record["semantics"])
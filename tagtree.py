@@ -155,9 +155,13 @@ class TAGTree(nltk.ParentedTree):
                 s._label = new_label
         return rename_dict
 
-    def substitute(self, t2, label):
-        """Returns this node after substituting the tree t2 at this location"""
-        node = self.find(label)
+    def substitute(self, t2, label, node=None):
+        """
+        Returns this node after substituting the tree t2 at this location. If
+        the node with that label is already known it can be given as node
+        """
+        if node is None:
+            node = self.find(label)
         t2 = t2.copy()
         t2.rename(self.label_counts())
         assert node.subst
@@ -167,9 +171,9 @@ class TAGTree(nltk.ParentedTree):
         node.subst = False
         return self
 
-    def adjoin(self, t2, label):
-        """Returns this node after adjoining the tree t2 at this location"""
-        adj_node = self.find(label)
+    def adjoin(self, t2, label, node=None):
+        """Returns this node after adjoining the tree t2 at this location (see substitute)"""
+        adj_node = node if node is not None else self.find(label)
         t2 = t2.copy()
         t2.rename(self.label_counts())
         assert not adj_node.subst and not adj_node.lex
@@ -193,8 +197,23 @@ class TAGTree(nltk.ParentedTree):
         return self
 
     def copy(self):
-        """Returns a deep copy of this tree"""
-        new_tree = TAGTree(self.label(), children=[c.copy() for c in self])
+        """
+        Returns a deep copy of this tree. Copies node by node with a stack
+        rather than recursively, so trees of any depth can be copied
+        """
+        new_tree = self.copy_node()
+        stack = [(self, new_tree)]
+        while len(stack) > 0:
+            node, new_node = stack.pop()
+            for c in node:
+                new_c = c.copy_node()
+                new_node.append(new_c)
+                stack.append((c, new_c))
+        return new_tree
+
+    def copy_node(self):
+        """Returns a copy of this node without its children"""
+        new_tree = TAGTree(self.label())
         new_tree.tree_name = self.tree_name
         new_tree.tree_family = self.tree_family
         new_tree.subst = self.subst
@@ -355,11 +374,11 @@ class SemTree(TAGTree):
             self.sem_var = self.sem_var.apply_binding(binding)
         return self
 
-    def substitute(self, tree2, label):
+    def substitute(self, tree2, label, node=None):
         tree2 = tree2.copy()
         tree2.rename(self) 
 
-        sub_node = self.find(label)
+        sub_node = node if node is not None else self.find(label)
         assert sub_node.subst
         assert sub_node.prefix() == tree2.prefix()
 
@@ -380,13 +399,13 @@ class SemTree(TAGTree):
 
         return self
 
-    def adjoin(self, tree2, label):
+    def adjoin(self, tree2, label, node=None):
         tree2 = tree2.copy()
 
         tree2.foot_node()._label = label # Force foot to lose the _f name scheme
         tree2.rename(self) 
 
-        adj_node = self.find(label)
+        adj_node = node if node is not None else self.find(label)
         foot = tree2.foot_node()
         assert adj_node is not None
         assert not adj_node.subst and not adj_node.lex
@@ -500,8 +519,9 @@ class SemTree(TAGTree):
             relations += s.semantics.relations
         return Semantics(relations)
 
-    def copy(self):
-        new_tree = SemTree(self.label(), children=[c.copy() for c in self])
+    def copy_node(self):
+        """Returns a copy of this node without its children (see TAGTree.copy)"""
+        new_tree = SemTree(self.label())
         new_tree.tree_name = self.tree_name
         new_tree.tree_family = self.tree_family
         new_tree.subst = self.subst
@@ -1,15 +1,21 @@
-import inflection
+import glob, inflection, io, json, multiprocessing, nltk, os, pickle, re, sys, tempfile
 
 from collections import defaultdict
+from xml.etree import ElementTree
 
 from grammar import Grammar
-from verbnet import VerbNet, XTAGMapper
-from propbank import Propbank
-from derivation import DerivationTree
+from verbnet import VerbNet, XTAGMapper, Frame
+from propbank import Propbank, PropbankStore, PropbankInstance, Role
+from derivation import DerivationTree, DerivationBundle, SkipFailedAttachments, StrictAttachments
 from semantics import Semantics, VariableFactory, Constant, Relation, Token, AndVariable, Variable
-from tagtree import SemTree
+from tagtree import TAGTree, SemTree
 from semparser import SemanticParser
-from semgrammar import SemTreeGrammar
+from semgrammar import SemTreeGrammar, CoverageReport
+from lemmatizer import AnchorLemmatizer
+from semserializer import SemanticsSerializer, SemanticsWriter, SemanticsReader
+from semcache import SemanticsCache
+from pipeline import AnnotationPipeline, DistributedPipeline, ShardQueue
+from instrumentation import Instrumentation
 
 g = Grammar.load()
 vnet = VerbNet.load()
@@ -26,6 +32,18 @@ def test_alphanx0Vnx1():
     sem = SemanticParser.parse("motion(during(e1),x0), motion(during(e1),x1), Agent(e1,x0), ISA(x0,CAT), Theme(e1,x1), ISA(x1,DOG)")
     assert chase.full_semantics().equiv(sem)
 
+def test_lemma_frame_choice():
+    # Only frames mapped to the tree's family are aligned, so the first of
+    # those (in VerbNet order) gives the semantics
+    frames = [f for f in vnet.get_frames('chase') if mapper.get_xtag_family(f.primary, f.secondary) == 'Tnx0Vnx1']
+    assert len(frames) > 0
+    assert vnet.get_frames_from_family('chase', 'Tnx0Vnx1') == frames
+
+    chase = s.get_semtree('alphanx0Vnx1', 'chase', lemma='chase')
+    frame = vnet.get_lexicalized_frame(frames[0], 'chase')
+    expected = s.add_semantics(g.get('alphanx0Vnx1'), 'chase', frame.np_var_order, frame.sem_dict)
+    assert chase.semantics.equiv(expected.semantics)
+
 def test_betaAn():
     red = s.get_semtree('betaAn', 'red')
     cat = s.get_semtree('alphaNXN', 'cat')
@@ -189,9 +207,753 @@ def test_betaCONJs():
     sem = SemanticParser.parse("motion(during(e1),x0), motion(during(e1),x1), Agent(e1,x0), ISA(x0,CAT), Theme(e1,x1), ISA(x1,DOG)")
     assert chase.full_semantics().equiv(sem)
 
+def test_parse_many():
+    strs = [
+        "EXISTS(x1)|ISA(x1,MR. VINKEN)",
+        "cause(x1,e1) ^ together(e1,physical,p1,p1) ^ Agent(e1,AND(x1,OR(x2,x3)))",
+        "motion(during(e1),x0), Agent(e1,x0)",
+    ]
+    sems = SemanticParser.parse_many(strs)
+    assert str(sems[0]) == Token.EXISTS + "x1 ISA(x1,MR.VINKEN)"
+    assert str(sems[1]) == strs[1]
+    assert isinstance(sems[1].relations[2].args[1], AndVariable)
+    assert sems[2].relations[0].args[0].event_type == "during"
+
+def test_serializer_round_trip():
+    sem_str = "EXISTS(x1)|motion(during(e1),x1) ^ Agent(e1,AND(x1,y1)) ^ ISA(x1,CAT)"
+    sem = SemanticParser.parse(sem_str)
+    assert str(SemanticsSerializer.from_string(SemanticsSerializer.to_string(sem))) == str(sem)
+
+    # Semantics from VerbNet have lowercase constants and typed variables,
+    # which the parser can't tell from plain variables
+    frame = Frame.fromxml("run-51.3.2", ElementTree.fromstring("""
+        <FRAME>
+            <DESCRIPTION primary="NP V" secondary="Intransitive"/>
+            <EXAMPLES><EXAMPLE>"The horse ran."</EXAMPLE></EXAMPLES>
+            <SYNTAX><NP value="Theme"/><VERB/></SYNTAX>
+            <SEMANTICS>
+                <PRED value="motion"><ARGS><ARG type="Event" value="during(E)"/><ARG type="ThemRole" value="Theme"/></ARGS></PRED>
+                <PRED value="path_rel"><ARGS><ARG type="Event" value="start(E)"/><ARG type="ThemRole" value="Theme"/><ARG type="Constant" value="physical"/></ARGS></PRED>
+            </SEMANTICS>
+        </FRAME>"""), 0)
+    sem = Semantics(frame.sem_dict["Event"].relations + [Relation("ISA", [Variable("x1"), Constant("MR. VINKEN")])])
+    sem.set_quantification(Variable("x1"), Token.EXISTS)
+
+    sink = io.StringIO()
+    SemanticsWriter(sink).write("0001_0.parse", sem)
+    sink.seek(0)
+    [(sentence, parsed)] = list(SemanticsReader(sink))
+    assert sentence == "0001_0.parse"
+    assert parsed.equiv(sem) and str(parsed) == str(sem)
+    assert parsed.event().name == sem.event().name and parsed.event().arg_type == "Event"
+    assert [a for r in parsed.relations for a in r.args if isinstance(a, Constant)] == [Constant("physical"), Constant("MR. VINKEN")]
+    assert [(v.name, v.event_type) for r in parsed.relations for v in r.args[:1]] == [(v.name, v.event_type) for r in sem.relations for v in r.args[:1]]
+
+def test_propbank_store():
+    role = Role("chase.01", "pursue", "51.6")
+    first = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "0", "chased", "chase.01", [], [1])
+    second = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "0", "chased", "chase.01", [], [4])
+    pb = Propbank({"chase.01": role}, {("0001", "0"): {"chased": second}}, {("0001", "0"): {1: first, 4: second}})
+
+    # Characters that mean something in a URI must not change the file opened
+    filename = os.path.join(tempfile.mkdtemp(), "prop?bank#1%.sqlite")
+    store = PropbankStore.build(pb, filename)
+    assert store.get_role("chase.01").vn_classes == ["51.6"]
+    assert store.get_instance("0001", "0", "chased", token_pos=1).token_positions == [1]
+    assert store.get_instance("0001", "0", "chased", token_pos=4).token_positions == [4]
+    assert store.get_vn_classes("0001", "0", "chased", token_pos=4) == ["51.6"]
+    assert store.get_instance("0001", "1", "chased") is None
+
+def elementary_tree(tree_name, tree_family, tree_str):
+    """
+    Returns a TAGTree from a bracketed string, in which labels ending in !
+    are substitution nodes, @ anchors and * feet
+    """
+    tree = TAGTree.convert(nltk.Tree.fromstring(tree_str))
+    for node in tree.subtrees():
+        node.tree_name, node.tree_family = tree_name, tree_family
+        for mark, attr in [("!", "subst"), ("@", "anchor"), ("*", "foot")]:
+            if node.label().endswith(mark):
+                node.set_label(node.label()[:-1])
+                setattr(node, attr, True)
+    return tree
+
+def test_token_positions():
+    # The relative clause's "ate" comes first in the sentence, though the
+    # main clause's comes first in the derivation
+    grammar = Grammar([
+        elementary_tree('alphanx0V', 'Tnx0V', "(S_r (NP_0! ) (VP (V@ )))"),
+        elementary_tree('alphaNXN', 'NXN', "(NP (N@ ))"),
+        elementary_tree('betaDnx', 'Dnx', "(NP_r (D@ ) (NP_f* ))"),
+        elementary_tree('betaN0nx0V', 'Tnx0V', "(NP_r (NP_f* ) (S_r (NP_w! ) (S (NP_0 ) (VP (V@ )))))"),
+        elementary_tree('betavxARB', 'vxARB', "(VP_r (VP_f* ) (Ad@ ))"),
+    ])
+    deriv = DerivationTree.from_dict({
+        "sentence": "the man who ate ate fast",
+        "deriv": "(alphanx0V[ate] (alphaNXN[man]<NP_0> betaDnx[the]<NP> (betaN0nx0V[ate]<NP> alphaNXN[who]<NP_w>)) betavxARB[fast]<VP>)",
+    }, "wsj_0001_0.parse")
+    deriv.align_tokens(grammar)
+    positions = {s.tree_name: s.token_pos for s in deriv.subtrees() if s.anchor != "who"}
+    assert positions == {'alphanx0V': 4, 'alphaNXN': 1, 'betaDnx': 0, 'betaN0nx0V': 3, 'betavxARB': 5}
+    assert [s.anchor for s in deriv.surface_order(grammar)] == "the man who ate ate fast".split()
+
+    # Each "ate" finds its own Propbank instance
+    relative = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "0", "ate", "eat.01", [], [3])
+    main = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "0", "ate", "eat.01", [], [4])
+    pb = Propbank({}, {("0001", "0"): {"ate": main}}, {("0001", "0"): {3: relative, 4: main}})
+    for s in deriv.subtrees():
+        if s.tree_name in ['alphanx0V', 'betaN0nx0V']:
+            instance = pb.get_instance(s.file_num, s.sentence_num, s.anchor, token_pos=s.token_pos)
+            assert instance is (main if s.tree_name == 'alphanx0V' else relative)
+
+def test_lemmatizer():
+    # Both forms of each pair are verbs, so the spelling rules have to pick
+    lemmas = ["wade", "wad", "lie", "ly", "hope", "hop", "ride", "rid", "sing", "singe", "pass", "stop", "fill", "try", "go", "agree"]
+    lemmatizer = AnchorLemmatizer(lemmas)
+    lemmatizer.use_wordnet = False
+    expected = {
+        "wades": "wade", "wading": "wade", "lying": "lie", "hopes": "hope",
+        "hoping": "hope", "hopped": "hop", "rides": "ride", "singing": "sing",
+        "passes": "pass", "stopped": "stop", "filled": "fill", "tries": "try",
+        "goes": "go", "agreed": "agree", "jumped": None,
+    }
+    lemmatizer.precompute([(word, 'v') for word in expected])
+    assert len(lemmatizer.memo) == len(expected)
+    for word, lemma in expected.items():
+        assert lemmatizer.lemmatize(word, 'v') == lemma
+
+def test_label_to_tree_word_loc():
+    assert DerivationTree.label_to_tree_word_loc("alphaNXN[chairman]<NP_1>") == ("alphaNXN", "chairman", "NP_1")
+    assert DerivationTree.label_to_tree_word_loc("alphanx0Vnx1[chased]") == ("alphanx0Vnx1", "chased", None)
+    # Anchors may themselves contain the delimiters
+    assert DerivationTree.label_to_tree_word_loc("alphaNXN[[]<NP_0>") == ("alphaNXN", "[", "NP_0")
+    assert DerivationTree.label_to_tree_word_loc("alphaNXN[<]>]<NP_0>") == ("alphaNXN", "<]>", "NP_0")
+    assert DerivationTree.label_to_tree_word_loc("betaCONJs[<>]") == ("betaCONJs", "<>", None)
+
+    deriv = DerivationTree.from_dict({"deriv": "(alphanx0V[ate] alphaNXN[[]<NP_0>)"}, "wsj_0001_3.parse")
+    assert [(s.tree_name, s.anchor, s.location) for s in deriv.subtrees()] == [("alphanx0V", "ate", None), ("alphaNXN", "[", "NP_0")]
+    assert [s.file_num for s in deriv.subtrees()] == ["0001", "0001"]
+
+    for label in ["alphaNXN", "alphaNXN[man", "alphaNXN[man]NP_0>"]:
+        try:
+            DerivationTree.label_to_tree_word_loc(label)
+            assert False, label
+        except ValueError:
+            pass
+
+def test_derivation_bundle():
+    grammar = Grammar([
+        elementary_tree('alphanx0V', 'Tnx0V', "(S_r (NP_0! ) (VP (V@ )))"),
+        elementary_tree('alphaNXN', 'NXN', "(NP (N@ ))"),
+        elementary_tree('betaDnx', 'Dnx', "(NP_r (D@ ) (NP_f* ))"),
+    ])
+    deriv_trees = [
+        DerivationTree.from_dict({"sentence": "the dog ran", "deriv": "(alphanx0V[ran] (alphaNXN[dog]<NP_0> betaDnx[the]<NP>))"}, "wsj_0002_10.parse"),
+        DerivationTree.from_dict({"deriv": "(alphanx0V[slept] alphaNXN[[]<NP_0>)"}, "wsj_0002_9.parse"),
+    ]
+    filename = os.path.join(tempfile.mkdtemp(), "derivation.bundle")
+    bundle = DerivationBundle.build(deriv_trees, filename, grammar)
+
+    # Reopened from the file, in (file_num, sent_num) order
+    bundle = pickle.loads(pickle.dumps(DerivationBundle.from_file(filename)))
+    assert len(bundle) == 2 and ("0002", "10") in bundle
+    assert bundle.sentence_ids() == [("0002", "9"), ("0002", "10")]
+    assert bundle.get("0002", "11") is None
+    for original, (file_num, sent_num) in zip(reversed(deriv_trees), bundle.sentence_ids()):
+        loaded = bundle.get(file_num, sent_num)
+        assert loaded == original
+        assert loaded.filename == original.filename
+        assert [(s.tree_name, s.anchor, s.location, s.token_pos, s.file_num, s.sentence_num) for s in loaded.subtrees()] == \
+            [(s.tree_name, s.anchor, s.location, s.token_pos, s.file_num, s.sentence_num) for s in original.subtrees()]
+    assert [s.token_pos for s in bundle.get("0002", "10").subtrees()] == [2, 1, 0]
+
+def test_load_all_manifest():
+    treedir = tempfile.mkdtemp()
+    pickle_filename = os.path.join(tempfile.mkdtemp(), "derivation.pickle")
+    def write(name, deriv):
+        with open(os.path.join(treedir, name), 'w') as f:
+            json.dump({"deriv": deriv}, f)
+    write("wsj_0001_0.parse", "(alphanx0V[ran] alphaNXN[dog]<NP_0>)")
+    write("wsj_0001_1.parse", "None")
+    write("wsj_0001_2.parse", "(alphanx0V[slept] alphaNXN[cat]<NP_0>)")
+
+    deriv_trees = DerivationTree.load_all(treedir, pickle_filename, processes=1)
+    assert [d.anchor for d in deriv_trees] == ["ran", "slept"]
+    cache = pickle.load(open(pickle_filename, 'rb'))
+    assert sorted(cache["manifest"]) == ["wsj_0001_0.parse", "wsj_0001_1.parse", "wsj_0001_2.parse"]
+
+    # Unchanged files come from the cache, not from disk
+    cache["trees"]["wsj_0001_0.parse"].anchor = "cached"
+    pickle.dump(cache, open(pickle_filename, 'wb'))
+    assert [d.anchor for d in DerivationTree.load_all(treedir, pickle_filename, processes=1)] == ["cached", "slept"]
+
+    # A touched file with the same contents is kept, a changed one is read again
+    # and a deleted one is dropped
+    filename = os.path.join(treedir, "wsj_0001_0.parse")
+    os.utime(filename, (0, 0))
+    os.remove(os.path.join(treedir, "wsj_0001_2.parse"))
+    write("wsj_0001_1.parse", "(alphanx0V[sat] alphaNXN[man]<NP_0>)")
+    assert [d.anchor for d in DerivationTree.load_all(treedir, pickle_filename, processes=1)] == ["cached", "sat"]
+    cache = pickle.load(open(pickle_filename, 'rb'))
+    assert sorted(cache["manifest"]) == ["wsj_0001_0.parse", "wsj_0001_1.parse"]
+    assert cache["manifest"]["wsj_0001_0.parse"]["mtime"] == 0
+
+def test_semantics_cache_resources():
+    data_dir = tempfile.mkdtemp() + "/"
+    cache_dir = os.path.join(data_dir, "semantics_cache")
+    names = [os.path.basename(f) for f in SemanticsCache.resource_filenames(data_dir)]
+    assert "lemmatizer.py" in names and "propbank.py" in names
+
+    # The pickles the resources are loaded from decide the semantics
+    resource_hash = SemanticsCache.load(cache_dir, data_dir).resource_hash
+    for name in ["xtag.pickle", "verbnet.pickle", "propbank.pickle"]:
+        with open(os.path.join(data_dir, name), 'wb') as f:
+            f.write(b"changed")
+        assert SemanticsCache.load(cache_dir, data_dir).resource_hash != resource_hash
+        resource_hash = SemanticsCache.load(cache_dir, data_dir).resource_hash
+
+def small_semgrammar():
+    """Returns a SemTreeGrammar of a few non-verb trees, without VerbNet or Propbank"""
+    grammar = Grammar([
+        elementary_tree('alphanx0V', 'Tnx0V', "(S_r (NP_0! ) (VP (V@ )))"),
+        elementary_tree('alphaNXN', 'NXN', "(NP (N@ ))"),
+        elementary_tree('betaDnx', 'Dnx', "(NP_r (D@ ) (NP_f* ))"),
+        elementary_tree('betaAn', 'An', "(N_r (A@ ) (N_f* ))"),
+    ])
+    return SemTreeGrammar(grammar, VerbNet({}, {}, {}, {}), XTAGMapper({}), Propbank({}, {}, {}))
+
+def write_parse_files(treedir, derivs):
+    """Writes a parse file wsj_0001_<i>.parse per derivation string, or raw text for bytes"""
+    for i, deriv in enumerate(derivs):
+        with open(os.path.join(treedir, "wsj_0001_%d.parse" % i), 'wb') as f:
+            f.write(deriv if isinstance(deriv, bytes) else json.dumps({"deriv": deriv}).encode('utf-8'))
+
+def test_pipeline_resume():
+    treedir, output_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    write_parse_files(treedir, [
+        "(alphaNXN[dog] betaDnx[the]<NP>)",
+        b"{\"deriv\": ", # Cut short
+        "(alphaNXN[cat] betaAn[red]<N>)",
+        "None",
+        "(alphanx0V[ran] alphaNXN[dog]<NP_0>)", # No lemma without VerbNet
+    ])
+    pipeline = AnnotationPipeline(output_dir, treedir=treedir, shard_size=2, processes=1, loader=small_semgrammar)
+    expected = {"success": 2, "JSONDecodeError": 1, "no_derivation": 1, "NotImplementedError": 1}
+    assert pipeline.run() == expected
+    assert [sentence for sentence, sem in pipeline.results()] == ["0001_0.parse", "0001_2.parse"]
+
+    # A run killed while writing shard 1 redoes that shard only, and clears
+    # the temp files it left
+    checkpoint = pipeline.load_checkpoint()
+    del checkpoint["done"]["1"]
+    pipeline.save_checkpoint(checkpoint)
+    os.remove(pipeline.shard_path(1))
+    open(os.path.join(output_dir, "tmpkilled.tmp"), 'w').close()
+    shard_0_mtime = os.stat(pipeline.shard_path(0)).st_mtime_ns
+    assert [shard_id for shard_id, filenames, path in pipeline.pending_jobs()] == [1]
+    assert pipeline.run() == expected
+    assert os.stat(pipeline.shard_path(0)).st_mtime_ns == shard_0_mtime
+    assert [sentence for sentence, sem in pipeline.results()] == ["0001_0.parse", "0001_2.parse"]
+    assert glob.glob(os.path.join(output_dir, "*.tmp")) == []
+    assert pipeline.pending_jobs() == []
+
+def test_shard_queue():
+    queue_dir = tempfile.mkdtemp()
+    first, second, third = [ShardQueue(queue_dir, 2, lease_seconds=60) for i in range(3)]
+    first.owner, second.owner, third.owner = "a:1", "b:1", "c:1"
+    assert first.claim() == 0
+    assert second.claim() == 1
+    assert third.claim() is None
+
+    # Only the holder of a lease can drop it
+    second.release(0)
+    assert first.read_lease(first.lease_path(0))[0] == "a:1"
+
+    # An expired lease is taken over once; a worker that saw it expire
+    # before the takeover can't break the new lease
+    os.utime(first.lease_path(0), (0, 0))
+    expired = third.read_lease(third.lease_path(0))
+    assert second.try_lease(0)
+    assert not third.move_lease(0, *expired)
+    assert not third.try_lease(0)
+    assert first.read_lease(first.lease_path(0))[0] == "b:1"
+
+    # The dead worker coming back neither renews nor drops the new lease
+    first.renew([0])
+    first.release(0)
+    assert first.read_lease(first.lease_path(0))[0] == "b:1"
+
+    second.complete(0, {"success": 3})
+    second.complete(1, {"success": 1, "KeyError": 1})
+    assert second.unfinished() == []
+    assert second.counts() == {0: {"success": 3}, 1: {"success": 1, "KeyError": 1}}
+    assert sorted(os.listdir(queue_dir)) == ["shard_00000.done", "shard_00001.done"]
+
+def test_distributed_pipeline_needs_plan():
+    output_dir = tempfile.mkdtemp()
+    pipeline = DistributedPipeline(output_dir, treedir=tempfile.mkdtemp(), processes=1, loader=small_semgrammar)
+    try:
+        pipeline.work()
+        assert False
+    except ValueError:
+        pass
+    assert not os.path.exists(pipeline.plan_path())
+
+def test_instrumentation():
+    semgrammar = small_semgrammar()
+    # betaDnx has no semantics for "some", so it's skipped every time
+    deriv = DerivationTree.from_dict({"deriv": "(alphaNXN[dog] betaDnx[the]<NP> (betaAn[red]<N> betaDnx[some]<NP>))"}, "wsj_0001_0.parse")
+    deriv.get_parse_tree(semgrammar)
+
+    # The subtree is memoized by now, but its failure is still counted each time
+    runs = []
+    for i in range(2):
+        stats = Instrumentation()
+        with stats.installed():
+            try:
+                with stats.installed():
+                    assert False
+            except AssertionError as e:
+                assert "installed" in str(e)
+            deriv.get_parse_tree(semgrammar, stats=stats)
+        runs.append(json.loads(json.dumps(stats.to_dict())))
+    assert runs[0]["failures"] == {"NotImplementedError": 1}
+    assert runs[0]["tree_failures"] == {"betaDnx": {"NotImplementedError": 1}}
+    assert runs[0]["tree_counts"] == {"alphaNXN": 1, "betaDnx": 1, "betaAn": 1}
+    assert runs[0]["counts"] == {"sentences": 1, "composed_sentences": 1}
+    assert runs[0]["sentences"][0]["failures"] == [{"tree": "betaDnx", "anchor": "some", "error": "NotImplementedError"}]
+    assert runs[0]["calls"]["copy"] > 0 and runs[0]["calls"]["adjoin"] == 2
+
+    merged = Instrumentation.merge(runs)
+    assert merged["failures"] == {"NotImplementedError": 2}
+    assert merged["tree_failures"] == {"betaDnx": {"NotImplementedError": 2}}
+    assert merged["tree_counts"]["betaDnx"] == 2
+    assert merged["counts"] == {"sentences": 2, "composed_sentences": 2}
+    assert merged["calls"] == {stage: 2 * count for stage, count in runs[0]["calls"].items()}
+    assert merged["timings"]["lookup"] == runs[0]["timings"]["lookup"] + runs[1]["timings"]["lookup"]
+    assert [s["sentence"] for s in merged["sentences"]] == ["0001_0", "0001_0"]
+    assert Instrumentation.merge([]) == Instrumentation().to_dict()
+
+def test_coverage_report():
+    semgrammar = small_semgrammar()
+    derivs = [
+        "(alphaNXN[dog] betaDnx[the]<NP>)",
+        "(alphaNXN[dog] (betaAn[red]<N> betaDnx[the]<NP>) betaDnx[a]<NP>)",
+        "(alphanx0V[ran] alphaNXN[dog]<NP_0>)",
+    ]
+    def parse(deriv):
+        return DerivationTree.from_dict({"deriv": deriv}, "wsj_0001_0.parse")
+
+    # Same test as prune_deriv_tree and have_semantics
+    tree_families, tree_set = {"NXN"}, {"betaDnx"}
+    report = CoverageReport.from_derivations([parse(d) for d in derivs], semgrammar, tree_families, tree_set)
+    assert (report.sentences, report.covered, report.prunable, report.lost) == (3, 1, 1, 1)
+    assert report.covered == sum(parse(d).have_semantics(semgrammar.grammar, tree_families, tree_set) for d in derivs)
+    pruned = [DerivationTree.prune_deriv_tree(semgrammar.grammar, parse(d), tree_families, tree_set) for d in derivs]
+    assert report.kept_nodes == sum(len(list(p.subtrees())) for p in pruned if p is not None) == 4
+    summary = report.to_dict()
+    assert summary["kept_node_fraction"] == 0.5
+    assert summary["trees"]["betaAn"] == {"count": 1, "annotated": 0}
+    assert summary["families"]["NXN"] == {"count": 3, "annotated": 3}
+
+    # By default, the trees the grammar can annotate; written by the pipeline
+    treedir, output_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    write_parse_files(treedir, derivs)
+    report = AnnotationPipeline(output_dir, treedir=treedir, processes=1, loader=small_semgrammar).coverage()
+    assert (report.sentences, report.covered, report.prunable, report.lost) == (3, 2, 0, 1)
+    with open(os.path.join(output_dir, "coverage.json"), 'r') as f:
+        assert json.load(f)["sentences"] == 3
+
+def test_composition_memo():
+    semgrammar = small_semgrammar()
+    deriv = DerivationTree.from_dict({"deriv": "(alphaNXN[dog] betaAn[red]<N> betaDnx[the]<NP>)"}, "wsj_0001_0.parse")
+    first = deriv.get_parse_tree(semgrammar).full_semantics()
+    hits = semgrammar.composition_memo.hits
+    second = deriv.get_parse_tree(semgrammar).full_semantics()
+    assert semgrammar.composition_memo.hits > hits
+    assert str(second) == str(first)
+
+    # A subtree composed by skipping a failed child isn't reused by a strict run
+    deriv = DerivationTree.from_dict({"deriv": "(alphaNXN[dog] (betaAn[red]<N> betaDnx[some]<NP>))"}, "wsj_0001_1.parse")
+    policy = SkipFailedAttachments()
+    deriv.get_parse_tree(semgrammar, policy=policy)
+    assert dict(policy.failures) == {NotImplementedError: 1}
+    try:
+        deriv.get_parse_tree(semgrammar, policy=StrictAttachments())
+        assert False
+    except NotImplementedError:
+        pass
+
+def vn_class_xml(class_id, members, frames, subclasses="", tag="VNCLASS"):
+    """
+    Returns the XML of a VerbNet class with a frame per (primary, [NP roles])
+    in frames; the verb comes after the first NP, and each frame's semantics
+    is cause(during(E), <roles>)
+    """
+    frames_xml = ""
+    for primary, roles in frames:
+        nps = ['<NP value="%s"/>' % r for r in roles]
+        syntax = "".join(nps[:1] + ['<VERB/>'] + nps[1:])
+        args = "".join('<ARG type="ThemRole" value="%s"/>' % r for r in roles)
+        frames_xml += ('<FRAME><DESCRIPTION primary="%s" secondary=""/><EXAMPLES><EXAMPLE>%s</EXAMPLE></EXAMPLES>'
+            '<SYNTAX>%s</SYNTAX><SEMANTICS><PRED value="cause"><ARGS><ARG type="Event" value="during(E)"/>%s</ARGS></PRED></SEMANTICS></FRAME>'
+            % (primary, primary, syntax, args))
+    members_xml = "".join('<MEMBER name="%s"/>' % m for m in members)
+    return ('<%s ID="%s"><MEMBERS>%s</MEMBERS><THEMROLES/><FRAMES>%s</FRAMES><SUBCLASSES>%s</SUBCLASSES></%s>'
+        % (tag, class_id, members_xml, frames_xml, subclasses, tag))
+
+def small_verbnet(class_xml):
+    """Returns a VerbNet compiled from a single class file with contents class_xml"""
+    path = os.path.join(tempfile.mkdtemp(), "class.xml")
+    with open(path, 'w') as f:
+        f.write(class_xml)
+    return VerbNet.from_templates({"class.xml": VerbNet.compile_file(path)})
+
+def verb_semgrammar():
+    """
+    Returns a SemTreeGrammar with a transitive verb tree and a Propbank
+    instance of "hit" in "John hit the ball" (wsj_0001_0). Both of hit's
+    frames fit the tree, but only the second gives ARG0 (an agent) to NP_0
+    """
+    verbnet = small_verbnet(vn_class_xml("hit-18.1", ["hit"], [
+        ("Instrument V NP", ["Instrument", "Patient"]),
+        ("NP V NP", ["Agent", "Patient"]),
+    ]))
+    grammar = Grammar([
+        elementary_tree('alphanx0Vnx1', 'Tnx0Vnx1', "(S_r (NP_0! ) (VP (V@ ) (NP_1! )))"),
+        elementary_tree('alphaNXN', 'NXN', "(NP (N@ ))"),
+        elementary_tree('betaDnx', 'Dnx', "(NP_r (D@ ) (NP_f* ))"),
+        elementary_tree('betaAn', 'An', "(N_r (A@ ) (N_f* ))"),
+    ])
+    mapper = XTAGMapper({("Instrument V NP", ""): "Tnx0Vnx1", ("NP V NP", ""): "Tnx0Vnx1"})
+    role = Role.fromxml(ElementTree.fromstring('<roleset id="hit.01" name="strike" vncls="18.1"><roles>'
+        '<role n="0" descr="hitter"><vnrole vncls="18.1" vntheta="Agent"/></role>'
+        '<role n="1" descr="thing hit"><vnrole vncls="18.1" vntheta="Patient"/></role></roles></roleset>'))
+    instance = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "0", "hit", "hit.01", [], [1],
+        [("ARG0", [(0, 1)]), ("ARG1", [(2, 4)]), ("ARGM-TMP", [(4, 5)])])
+    pb = Propbank({"hit.01": role}, {("0001", "0"): {"hit": instance}}, {("0001", "0"): {1: instance}})
+    return SemTreeGrammar(grammar, verbnet, mapper, pb)
+
+def test_argument_alignment():
+    semgrammar = verb_semgrammar()
+    grammar, pb = semgrammar.grammar, semgrammar.propbank
+    assert pb.get_role("hit.01").get_themroles("ARG0") == {"agent"}
+    instance = pb.get_instance("0001", "0", "hit", token_pos=1)
+
+    deriv = DerivationTree.from_dict({
+        "sentence": "John hit the ball",
+        "deriv": "(alphanx0Vnx1[hit] alphaNXN[John]<NP_0> (alphaNXN[ball]<NP_1> betaDnx[the]<NP>))",
+    }, "wsj_0001_0.parse")
+    deriv.align_tokens(grammar)
+    alignment = deriv.argument_alignment(pb)
+    assert alignment.get_nodes(1, "ARG1") == [("alphaNXN", "NP_1", 3)]
+    assert alignment.get_argument(1, 0) == "ARG0"
+    assert alignment.get_nodes(1, "ARGM-TMP") == [] # Past the end of the derivation
+    assert alignment.child_arguments(deriv, instance) == (("NP_0", "ARG0"), ("NP_1", "ARG1"))
+    assert deriv.frame_choice(semgrammar, alignment) == ("hit.01", (("NP_0", "ARG0"), ("NP_1", "ARG1")))
+
+    # Without the arguments the first frame is taken
+    semtree = semgrammar.get_semtree('alphanx0Vnx1', 'hit', pb_instance=instance)
+    assert "Instrument" in str(semtree.full_semantics())
+    sem = str(deriv.get_parse_tree(semgrammar).full_semantics())
+    assert "Agent" in sem and "Instrument" not in sem
+
+def empty_semgrammar():
+    """Returns a SemTreeGrammar without any trees"""
+    return SemTreeGrammar(Grammar([]), VerbNet({}, {}, {}, {}), XTAGMapper({}), Propbank({}, {}, {}))
+
+def test_pipeline_worker_state():
+    # A later pipeline in the same process loads its own grammar and cache
+    treedir, cache_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    write_parse_files(treedir, ["(alphaNXN[dog] betaDnx[the]<NP>)"])
+    counts = AnnotationPipeline(tempfile.mkdtemp(), treedir=treedir, processes=1, cache_dir=cache_dir, loader=small_semgrammar).run()
+    assert counts == {"success": 1}
+    assert AnnotationPipeline.worker_cache is not None
+
+    counts = AnnotationPipeline(tempfile.mkdtemp(), treedir=treedir, processes=1, loader=empty_semgrammar).run()
+    assert "success" not in counts
+    assert AnnotationPipeline.worker_cache is None
+    report = AnnotationPipeline(tempfile.mkdtemp(), treedir=treedir, processes=1, loader=small_semgrammar).coverage()
+    assert report.covered == 1
+
+def test_repeated_verb_instance():
+    # Only the second "chased" has an instance, so the first gets none
+    # rather than the second's; without positions the word is enough
+    second = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "0", "chased", "chase.01", [], [4])
+    old = PropbankInstance("wsj/00/wsj_0001.mrg", "0001", "1", "chased", "chase.01", [])
+    pb = Propbank({"chase.01": Role("chase.01", "pursue", "51.6")},
+        {("0001", "0"): {"chased": second}, ("0001", "1"): {"chased": old}},
+        {("0001", "0"): {4: second}})
+    store = PropbankStore.build(pb, os.path.join(tempfile.mkdtemp(), "propbank.sqlite"))
+    for propbank in [pb, store]:
+        assert propbank.get_instance("0001", "0", "chased", token_pos=1) is None
+        assert propbank.get_vn_classes("0001", "0", "chased", token_pos=1) == []
+        assert propbank.get_instance("0001", "0", "chased", token_pos=4).token_positions == [4]
+        assert propbank.get_instance("0001", "0", "chased").token_positions == [4]
+        assert propbank.get_instance("0001", "1", "chased", token_pos=2).sentnum == "1"
+
+def test_class_family_frames():
+    subclass = vn_class_xml("hit-18.1-1", ["bang"], [("NP V", ["Agent"])], tag="VNSUBCLASS")
+    verbnet = small_verbnet(vn_class_xml("hit-18.1", ["hit"], [
+        ("NP V NP", ["Agent", "Patient"]),
+        ("NP V", ["Patient"]),
+        ("NP V NP PP", ["Agent", "Patient"]),
+    ], subclass))
+    mapper = XTAGMapper({("NP V NP", ""): "Tnx0Vnx1", ("NP V", ""): "Tnx0V"})
+    verbnet.build_family_index(mapper)
+    assert verbnet.has_family_index(mapper)
+    assert not verbnet.has_family_index(XTAGMapper({}))
+
+    # Frames that map to no family aren't in the table at all
+    frames = verbnet.get_frames_from_class_family("18.1", "Tnx0Vnx1")
+    assert [(f.vn_class, f.frame_num) for f in frames] == [("hit-18.1", 0)]
+    # A subclass reaches its own frames, then its parent's
+    frames = verbnet.get_frames_from_class_family("18.1-1", "Tnx0V")
+    assert [(f.vn_class, f.frame_num) for f in frames] == [("hit-18.1-1", 0), ("hit-18.1", 1)]
+    assert verbnet.get_frames_from_class_family("18.1", "Tnx0Vs1") == []
+    assert verbnet.get_frames_from_class_family("-", "Tnx0V") == []
+
+def test_class_index():
+    grandchild = vn_class_xml("chase-51.6-1-1", ["tail"], [("NP V NP.theme", ["Agent", "Theme"])], tag="VNSUBCLASS")
+    child = vn_class_xml("chase-51.6-1", ["follow"], [("NP V", ["Agent"])], grandchild, tag="VNSUBCLASS")
+    verbnet = small_verbnet(vn_class_xml("chase-51.6", ["chase"], [("NP V NP", ["Agent", "Theme"])], child))
+
+    assert verbnet.resolve_class("51.6") == "chase-51.6"
+    assert verbnet.resolve_class("chase-51.6-1") == "chase-51.6-1"
+    assert verbnet.resolve_class("51.6-1-1") == "chase-51.6-1-1"
+    # Unknown subclasses resolve to their closest known parent
+    assert verbnet.resolve_class("51.6-1-7") == "chase-51.6-1"
+    assert verbnet.resolve_class("51.6-9") == "chase-51.6"
+    assert verbnet.resolve_class("-") is None
+    try:
+        verbnet.resolve_class("99.9")
+        assert False
+    except KeyError:
+        pass
+
+    # Own frames, then ancestors' (closest first), then descendants'
+    def classes(class_id):
+        return [f.vn_class for f in verbnet.get_frames_from_class(class_id)]
+    assert classes("51.6-1") == ["chase-51.6-1", "chase-51.6", "chase-51.6-1-1"]
+    assert classes("51.6-1-1") == ["chase-51.6-1-1", "chase-51.6-1", "chase-51.6"]
+    assert classes("51.6-9") == ["chase-51.6", "chase-51.6-1", "chase-51.6-1-1"]
+
+def test_verbnet_templates():
+    dirname = tempfile.mkdtemp()
+    template_filename = os.path.join(tempfile.mkdtemp(), "verbnet_templates.json")
+    with open(os.path.join(dirname, "chase-51.6.xml"), 'w') as f:
+        f.write(vn_class_xml("chase-51.6", ["chase"], [("NP V NP", ["Agent", "Theme"])]))
+    verbnet = VerbNet.fromxml(dirname, template_filename, processes=1)
+    frame = verbnet.get_frames("chase")[0]
+    assert (frame.vn_class, frame.primary, frame.example) == ("chase-51.6", "NP V NP", "NP V NP")
+    with open(template_filename, 'r') as f:
+        templates = json.load(f)
+    assert templates["chase-51.6.xml"]["version"] == VerbNet.TEMPLATE_VERSION
+
+    # Unchanged files come from the templates without being parsed again
+    templates["chase-51.6.xml"]["classes"][0][2][0]["example"] = "cached"
+    with open(template_filename, 'w') as f:
+        json.dump(templates, f)
+    assert VerbNet.fromxml(dirname, template_filename, processes=1).get_frames("chase")[0].example == "cached"
+
+    # Templates compiled by another version are compiled again
+    templates["chase-51.6.xml"]["version"] = VerbNet.TEMPLATE_VERSION - 1
+    with open(template_filename, 'w') as f:
+        json.dump(templates, f)
+    assert VerbNet.fromxml(dirname, template_filename, processes=1).get_frames("chase")[0].example == "NP V NP"
+
+def test_verbnet_changed_files():
+    dirname = tempfile.mkdtemp()
+    template_filename = os.path.join(tempfile.mkdtemp(), "verbnet_templates.json")
+    for class_id, lemma in [("chase-51.6", "chase"), ("hit-18.1", "hit")]:
+        with open(os.path.join(dirname, class_id + ".xml"), 'w') as f:
+            f.write(vn_class_xml(class_id, [lemma], [("NP V NP", ["Agent", "Theme"])]))
+    # A pool of processes gives the same frames as parsing in this process
+    pooled = VerbNet.fromxml(dirname, os.path.join(tempfile.mkdtemp(), "pooled.json"), processes=2)
+    verbnet = VerbNet.fromxml(dirname, template_filename, processes=1)
+    for lemma in ["chase", "hit"]:
+        assert [f.to_template() for f in pooled.get_frames(lemma)] == [f.to_template() for f in verbnet.get_frames(lemma)]
+    assert verbnet.source_files == VerbNet.source_files(dirname)
+
+    # Only the file whose mtime changed is parsed again
+    with open(template_filename, 'r') as f:
+        templates = json.load(f)
+    for record in templates.values():
+        record["classes"][0][2][0]["example"] = "cached"
+    with open(template_filename, 'w') as f:
+        json.dump(templates, f)
+    path = os.path.join(dirname, "hit-18.1.xml")
+    os.utime(path, (os.stat(path).st_atime, os.stat(path).st_mtime + 10))
+    verbnet = VerbNet.fromxml(dirname, template_filename, processes=1)
+    assert verbnet.get_frames("chase")[0].example == "cached"
+    assert verbnet.get_frames("hit")[0].example == "NP V NP"
+
+def test_frame_lexicalize():
+    class_xml = vn_class_xml("run-51.3.2", ["run"], [("NP V", ["Theme"])])
+    class_xml = class_xml.replace('<ARG type="Event" value="during(E)"/>', '<ARG type="Event" value="during(E)"/><ARG type="VerbSpecific" value="V_Manner"/>')
+    verbnet = small_verbnet(class_xml)
+    frame = verbnet.get_frames("run")[0]
+
+    # Frames are shared, so they can't be changed
+    try:
+        frame.primary = "NP V NP"
+        assert False
+    except AttributeError:
+        pass
+    try:
+        frame.sem_dict["Event"] = Semantics([])
+        assert False
+    except TypeError:
+        pass
+
+    run = verbnet.get_lexicalized_frame(frame, "run")
+    assert verbnet.get_lexicalized_frame(frame, "run") is run
+    assert "__ANCHOR__" in str(frame.sem_dict["Event"]) and "RUN" not in str(frame.sem_dict["Event"])
+    assert "RUN" in str(run.sem_dict["Event"]) and "__ANCHOR__" not in str(run.sem_dict["Event"])
+    assert (run.lemma, frame.lemma) == ("run", None)
+
+    loaded = pickle.loads(pickle.dumps(run))
+    assert loaded.to_template() == run.to_template()
+    assert isinstance(loaded.np_var_order, tuple)
+    try:
+        loaded.sem_dict.clear()
+        assert False
+    except TypeError:
+        pass
+
+def test_attachment_depth():
+    # "red" adjoins at the N of "ball", which isn't a site of "hit": the
+    # sites of a child's subtree aren't sites of its parent
+    semgrammar = verb_semgrammar()
+    deriv = DerivationTree.from_dict({"deriv": "(alphanx0Vnx1[hit] alphaNXN[John]<NP_0> (alphaNXN[ball]<NP_1> betaAn[red]<N>))"}, "wsj_0001_0.parse")
+    assert "ISA(x2,RED)" in str(deriv.get_parse_tree(semgrammar).full_semantics())
+
+    deriv = DerivationTree.from_dict({"deriv": "(alphanx0Vnx1[hit] alphaNXN[John]<NP_0> alphaNXN[ball]<NP_1> betaAn[red]<N>)"}, "wsj_0001_0.parse")
+    try:
+        deriv.get_parse_tree(semgrammar)
+        attached = True
+    except AssertionError: # No adjunction site
+        attached = False
+    assert not attached
+
+def test_deep_derivation():
+    # Composing doesn't recurse per derivation level, so a derivation deeper
+    # than the recursion limit works (only the derived tree's own walks
+    # recurse, one call per level)
+    deriv_str = "(alphaNXN[dog] " + "".join("(betaAn[a%d]<%s> " % (i, "N" if i == 0 else "N_r") for i in range(300)) + ")" * 301
+    deriv = DerivationTree.from_dict({"deriv": deriv_str}, "wsj_0001_0.parse")
+    semgrammar = small_semgrammar()
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(500)
+    try:
+        semtree = deriv.get_parse_tree(semgrammar)
+    finally:
+        sys.setrecursionlimit(limit)
+    assert len(semtree.full_semantics().relations) == 301
+
+def test_failure_policies():
+    semgrammar = small_semgrammar()
+    # "some" has no semantics and alphanx0V no lemma without VerbNet. A
+    # skipped child is dropped along with everything below it
+    deriv = DerivationTree.from_dict({"deriv": "(alphaNXN[dog] betaAn[red]<N> (betaDnx[some]<NP> betaAn[big]<N>) (betaAn[old]<N> betaDnx[some]<NP>))"}, "wsj_0001_0.parse")
+    policy = SkipFailedAttachments()
+    sem = str(deriv.get_parse_tree(semgrammar, policy=policy).full_semantics())
+    assert "RED" in sem and "OLD" in sem and "BIG" not in sem
+    assert dict(policy.failures) == {NotImplementedError: 2}
+
+    for deriv_str in ["(alphaNXN[dog] betaDnx[some]<NP>)", "(alphanx0V[ran] alphaNXN[dog]<NP_0>)"]:
+        deriv = DerivationTree.from_dict({"deriv": deriv_str}, "wsj_0001_0.parse")
+        try:
+            deriv.get_parse_tree(semgrammar, policy=StrictAttachments())
+            assert False
+        except NotImplementedError:
+            pass
+
+def write_ptb_fixture(ptb_root):
+    """Writes two small WSJ files under ptb_root, returns their prop.txt lines by section"""
+    trees = {
+        "wsj/00/wsj_0001.mrg": [
+            "( (S (NP-SBJ (NNP John)) (VP (VBD chased) (NP (DT the) (NN cat))) (. .)) )",
+            "( (S (NP-SBJ-1 (NNP Mary)) (VP (VBD wanted) (S (NP-SBJ (-NONE- *-1)) (VP (TO to) (VP (VB chase) (NP (PRP him)))))) (. .)) )",
+        ],
+        "wsj/01/wsj_0101.mrg": [
+            "( (S (NP-SBJ (DT The) (NN dog)) (VP (VBD gave) (NP (PRP it)) (PRT (RP up))) (. .)) )",
+        ],
+    }
+    for fileid, sents in trees.items():
+        path = os.path.join(ptb_root, fileid.upper())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write("\n".join(sents) + "\n")
+    return {
+        "00": [
+            "wsj/00/wsj_0001.mrg 0 1 gold chase.01 vp--a 0:1-ARG0 1:0-rel 2:1-ARG1",
+            "wsj/00/wsj_0001.mrg 1 1 gold want.01 vp--a 0:1-ARG0 1:0-rel 2:2-ARG1",
+            "wsj/00/wsj_0001.mrg 1 4 gold chase.01 i---a 2:0*0:1-ARG0 4:0-rel 5:1-ARG1",
+        ],
+        "01": [
+            "wsj/01/wsj_0101.mrg 0 2 gold give.08 vp--a 0:1-ARG0 2:0,4:1-rel 3:1-ARG1",
+        ],
+    }
+
+def test_propbank_sections():
+    ptb_root = tempfile.mkdtemp()
+    section_lines = write_ptb_fixture(ptb_root)
+    # nltk only reads corpora under its data path
+    nltk.data.path.append(ptb_root)
+    try:
+        check_propbank_sections(ptb_root, section_lines)
+    finally:
+        nltk.data.path.remove(ptb_root)
+
+def check_propbank_sections(ptb_root, section_lines):
+    jobs = [(ptb_root, section_lines[section]) for section in sorted(section_lines)]
+
+    def summary(section_dicts):
+        return [(key, word, i.token_positions, i.argument_spans, i.roleset_id)
+                for instance_dict, position_dict in section_dicts
+                for key, instances in sorted(instance_dict.items())
+                for word, i in instances.items()]
+    sequential = [Propbank.read_section(job) for job in jobs]
+    with multiprocessing.Pool(2) as pool:
+        assert summary(pool.map(Propbank.read_section, jobs)) == summary(sequential)
+    assert [(key, word) for key, word, _, _, _ in summary(sequential)] == [
+        (("0001", "0"), "chased"), (("0001", "1"), "wanted"), (("0001", "1"), "chase"), (("0101", "0"), ("gave", "up"))]
+
+    # Same words and spans as NLTK's own tree pointer walk, which doesn't
+    # reuse the leaf positions of each sentence
+    instance_dict = {key: instances for section_dict, _ in sequential for key, instances in section_dict.items()}
+    for lines in section_lines.values():
+        for line in lines:
+            instance = nltk.corpus.reader.propbank.PropbankInstance.parse(line)
+            tree = nltk.corpus.reader.BracketParseCorpusReader(ptb_root, [instance.fileid.upper()]).parsed_sents()[instance.sentnum]
+            pieces = getattr(instance.predicate, 'pieces', [instance.predicate])
+            words = tuple(tree[p.treepos(tree)].leaves()[0] for p in pieces)
+            pb_instance = instance_dict[(instance.fileid[11:15], str(instance.sentnum))][words if len(words) > 1 else words[0]]
+            token_index = Propbank.leaf_to_token_index(tree)
+            assert pb_instance.argument_spans == Propbank.argument_spans(instance.arguments, tree, token_index)
+            assert pb_instance.token_positions == [token_index[p.wordnum] for p in pieces]
+
+def test_label_parts_match_regex():
+    # The regexes label_to_tree_word_loc replaced, which agree with it on
+    # every label whose anchor has no delimiters in it
+    def regex_label_parts(label):
+        tree_name = re.search(r'(.*)\[', label).group(1)
+        word = re.search(r'\[(.*?)\]', label).group(1)
+        loc_match = re.search(r'\<(.*?)\>', label)
+        return tree_name, word, loc_match.group(1) if loc_match is not None else None
+    labels = [
+        "alphanx0Vnx1[chased]", "alphaNXN[chairman]<NP_1>", "betaDnx[the]<NP>", "betaVvx[will]<VP>",
+        "alphaNXN[-LRB-]<NP_0>", "betanxPUnx[,]<NP_0>", "alphaNXN[3.5]<NP>", "alphaNXN[AT&T]<NP_1>",
+        "betaCONJs[and]<S_r>", "alphaNXN[Mr.]<NP_w>", "betaARBvx[n't]<VP>", "alphaNXN[]<NP>",
+    ]
+    for label in labels:
+        assert DerivationTree.label_to_tree_word_loc(label) == regex_label_parts(label)
+
 if __name__ == '__main__':
     funcs = [
         test_alphanx0Vnx1,
+        test_lemma_frame_choice,
         test_betaAn,
         test_betaVvx,
         test_betanxPnx,
@@ -207,6 +969,34 @@ if __name__ == '__main__':
         test_betas1CONJs2,
         test_betaARBs,
         test_betaCONJs,
+        test_parse_many,
+        test_serializer_round_trip,
+        test_propbank_store,
+        test_token_positions,
+        test_lemmatizer,
+        test_label_to_tree_word_loc,
+        test_derivation_bundle,
+        test_load_all_manifest,
+        test_semantics_cache_resources,
+        test_pipeline_resume,
+        test_shard_queue,
+        test_distributed_pipeline_needs_plan,
+        test_instrumentation,
+        test_coverage_report,
+        test_composition_memo,
+        test_argument_alignment,
+        test_pipeline_worker_state,
+        test_repeated_verb_instance,
+        test_class_family_frames,
+        test_class_index,
+        test_verbnet_templates,
+        test_verbnet_changed_files,
+        test_frame_lexicalize,
+        test_attachment_depth,
+        test_deep_derivation,
+        test_failure_policies,
+        test_propbank_sections,
+        test_label_parts_match_regex,
     ]
     for func in funcs:
         func()
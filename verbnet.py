@@ -1,29 +1,193 @@
-import os, pickle, re
+import copy, json, multiprocessing, os, pickle, re
 
-from collections import defaultdict
-from nltk.corpus.reader.verbnet import VerbnetCorpusReader
+from collections import defaultdict, OrderedDict
+from xml.etree import ElementTree
 
 from vnet_constants import DATA_DIR
-from semantics import Semantics, VariableFactory
+from semantics import Semantics, Variable, VariableFactory, VariableBinding, Constant
 
 class VerbNet(object):
     """
     Class storing the full set of VerbNet Frames. Provides an interface to get
     all of the frames associated with a given lemma
     """
+    LEXICALIZED_CACHE_SIZE = 10000
+    TEMPLATE_VERSION = 1 # Bumped when compile_file changes, so cached templates are compiled again
 
     def __init__(self, lemma_to_classes, class_to_frames, frame_dict, class_id_dict):
         self.lemma_to_classes = lemma_to_classes # {chase -> [chase-51.6]}
         self.class_to_frames = class_to_frames # {chase-51.6 -> [chase, follow, pursue, ...]}
         self.class_id_dict = class_id_dict # {51.6 -> chase-51.6}
+        self.class_resolution = None # {51.6 -> chase-51.6, chase-51.6 -> chase-51.6, ...}, see build_class_index
+        self.class_reachable_frames = None # {chase-51.6-1 -> [Frame, ...]} incl. inherited frames
+        self.lexicalized_frames = OrderedDict() # {(chase-51.6, 0, chase) -> Frame}, LRU order
+        self.family_index = None # {chase -> {Tnx0Vnx1 -> [Frame, ...]}}, see build_family_index
+        self.class_family_frames = None # {(chase-51.6, Tnx0Vnx1) -> [Frame, ...]}, see build_family_index
+        self.family_index_mapping = None # xtag mapping the family index was built from
+        self.source_files = None # {fileid: (mtime, size)} of the class files this was built from
 
     def get_frames_from_class(self, class_id):
-        if class_id in self.class_id_dict:
-            class_id = self.class_id_dict[class_id]
+        """
+        Returns all frames reachable from a class (full or shortened id): its
+        own frames, then those inherited from its parent classes, then those
+        of its subclasses. Subclass frames are merged in on purpose, as
+        Propbank often names the parent class of the frame a verb uses; so
+        an unknown subclass like 51.6-9 resolves to chase-51.6 and gets the
+        frames of chase-51.6-1 too. Raises KeyError for unknown classes
+        """
+        class_id = self.resolve_class(class_id)
+        if class_id is None:
+            return []
+
+        return self.class_reachable_frames[class_id]
+
+    def resolve_class(self, class_id):
+        """
+        Returns the full class id for a full or shortened class id, or None
+        for "-". Ids of unknown subclasses (e.g. 51.6-9) resolve to their
+        closest known parent. Raises KeyError if nothing matches
+        """
         if class_id == '-':
+            return None
+
+        # getattr b/c pickles from before the index existed don't have it
+        if getattr(self, 'class_resolution', None) is None:
+            self.build_class_index()
+
+        key = class_id
+        while key not in self.class_resolution and "-" in key:
+            key = key.rsplit("-", 1)[0]
+        if key not in self.class_resolution:
+            raise KeyError(class_id)
+        return self.class_resolution[key]
+
+    def build_class_index(self):
+        """
+        Returns self after precomputing the class resolution index: every full
+        and shortened class id -> full class id, and every full class id -> all
+        frames reachable through the class hierarchy (see get_frames_from_class).
+        The hierarchy is given by the ids themselves: chase-51.6-1 is a
+        subclass of chase-51.6
+        """
+        children = defaultdict(list)
+        for vn_class in sorted(self.class_to_frames):
+            parent = vn_class.rsplit("-", 1)[0]
+            if parent in self.class_to_frames:
+                children[parent].append(vn_class)
+
+        class_resolution = {}
+        class_reachable_frames = {}
+        for vn_class in self.class_to_frames:
+            class_resolution[vn_class] = vn_class
+
+            ancestors = []
+            parent = vn_class.rsplit("-", 1)[0]
+            while parent in self.class_to_frames:
+                ancestors.append(parent)
+                parent = parent.rsplit("-", 1)[0]
+
+            descendants = []
+            stack = list(reversed(children[vn_class]))
+            while len(stack) > 0:
+                c = stack.pop()
+                descendants.append(c)
+                stack += reversed(children[c])
+
+            frames = []
+            for cid in [vn_class] + ancestors + descendants:
+                frames += self.class_to_frames[cid]
+            class_reachable_frames[vn_class] = frames
+
+        for short_id, vn_class in self.class_id_dict.items():
+            class_resolution[short_id] = vn_class
+
+        self.class_resolution = class_resolution
+        self.class_reachable_frames = class_reachable_frames
+        return self
+
+    def build_family_index(self, xtag_mapper):
+        """
+        Returns self after precomputing, for every lemma, the XTAG tree families
+        its frames map to and the frames for each family. Also builds the
+        (class, family) -> frames compatibility table, over the frames reachable
+        from each class. Frames that don't map to any family are left out
+        """
+        if getattr(self, 'class_reachable_frames', None) is None:
+            self.build_class_index()
+
+        class_family_frames = defaultdict(list)
+        for vn_class, frames in self.class_reachable_frames.items():
+            for f in frames:
+                xtag_family = xtag_mapper.get_xtag_family(f.primary, f.secondary)
+                if xtag_family is not None:
+                    class_family_frames[(vn_class, xtag_family)].append(f)
+
+        family_index = {}
+        for lemma, classes in self.lemma_to_classes.items():
+            families = defaultdict(list)
+            for cid in classes:
+                for f in self.class_to_frames[cid]:
+                    xtag_family = xtag_mapper.get_xtag_family(f.primary, f.secondary)
+                    if xtag_family is not None:
+                        families[xtag_family].append(f)
+            family_index[lemma] = dict(families)
+
+        self.family_index = family_index
+        self.class_family_frames = dict(class_family_frames)
+        self.family_index_mapping = dict(xtag_mapper.xtag_mapping)
+        return self
+
+    def has_family_index(self, xtag_mapper):
+        """Returns True if the family index is built and matches xtag_mapper"""
+        # getattr b/c pickles from before the index existed don't have it
+        mapping = getattr(self, 'family_index_mapping', None)
+        if getattr(self, 'class_family_frames', None) is None:
+            return False
+        return mapping is not None and mapping == xtag_mapper.xtag_mapping
+
+    def get_tree_families(self, lemma):
+        """Returns all tree families that the frames of lemma map to"""
+        assert lemma in self.lemma_to_classes
+        return set(self.family_index[lemma])
+
+    def get_frames_from_family(self, lemma, tree_family):
+        """Returns the frames of lemma that map to tree_family"""
+        assert lemma in self.lemma_to_classes
+        return self.family_index[lemma].get(tree_family, [])
+
+    def get_frames_from_class_family(self, class_id, tree_family):
+        """
+        Returns the frames reachable from a class (full or shortened id) that
+        map to tree_family. Like get_frames_from_class, raises KeyError for
+        unknown classes
+        """
+        class_id = self.resolve_class(class_id)
+        if class_id is None:
             return []
 
-        return self.class_to_frames[class_id]
+        return self.class_family_frames.get((class_id, tree_family), [])
+
+    def get_lexicalized_frame(self, frame, lemma):
+        """
+        Returns frame lexicalized with lemma. Results are kept in a bounded LRU
+        cache keyed by (class, frame_num, lemma), so repeated verbs reuse the
+        same lexicalized frame. The returned frame is shared, so its semantics
+        must be copied before they're modified
+        """
+        # getattr b/c pickles from before the cache existed don't have it
+        if getattr(self, 'lexicalized_frames', None) is None:
+            self.lexicalized_frames = OrderedDict()
+
+        key = (frame.vn_class, frame.frame_num, lemma)
+        if key in self.lexicalized_frames:
+            self.lexicalized_frames.move_to_end(key)
+            return self.lexicalized_frames[key]
+
+        lexicalized = frame.lexicalize(lemma)
+        self.lexicalized_frames[key] = lexicalized
+        if len(self.lexicalized_frames) > self.LEXICALIZED_CACHE_SIZE:
+            self.lexicalized_frames.popitem(last=False)
+        return lexicalized
 
     def get_frames(self, lemma, class_id=None):
         """Returns all frames associated with a lemma. Filters by class id if provided"""
@@ -39,78 +203,226 @@ class VerbNet(object):
         return frames
 
     @classmethod
-    def fromxml(cls, dirname=DATA_DIR + 'verbnet'):
+    def fromxml(cls, dirname=DATA_DIR + 'verbnet', template_filename=DATA_DIR + 'verbnet_templates.json', processes=None):
         """
         Returns VerbNet object after parsing the full VerbNet corpus from directory
-        of XML files
+        of XML files. Frames are compiled to templates which are cached per
+        class file, so only files that changed since the last build are parsed.
+        Changed files are parsed in parallel over a pool of processes (all
+        cores by default, processes=1 parses in this process)
         """
+        templates = cls.load_templates(template_filename)
+        source_files = cls.source_files(dirname)
+
+        new_templates = {}
+        changed = []
+        for fileid, (mtime, size) in sorted(source_files.items()):
+            cached = templates.get(fileid)
+            if cached is not None and cached["mtime"] == mtime and cached["size"] == size and cached.get("version") == cls.TEMPLATE_VERSION:
+                new_templates[fileid] = cached
+            else:
+                changed.append(fileid)
+
+        paths = [os.path.join(dirname, fileid) for fileid in changed]
+        if processes == 1 or len(paths) <= 1:
+            records = [cls.compile_file(path) for path in paths]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                records = pool.map(cls.compile_file, paths)
+        new_templates.update(zip(changed, records))
 
-        class_to_frames = {}
-        lemma_to_classes = defaultdict(list)
-        frame_dict = {}
-        class_id_dict = {}
+        with open(template_filename, 'w') as f:
+            json.dump(new_templates, f)
 
-        vnet = VerbnetCorpusReader(dirname, r'.*.xml')
-        for vn_class in vnet.classids():
-            frames = []
+        verbnet = cls.from_templates(new_templates)
+        verbnet.source_files = source_files
+        return verbnet
 
-            try:
-                frame_xmls = vnet.vnclass(vn_class).find("FRAMES")
-            except AssertionError:
+    @classmethod
+    def source_files(cls, dirname=DATA_DIR + 'verbnet'):
+        """Returns {fileid: (mtime, size)} for the class files in dirname, or None if it doesn't exist"""
+        if not os.path.isdir(dirname):
+            return None
+        source_files = {}
+        for fileid in os.listdir(dirname):
+            if fileid.endswith('.xml'):
+                stat = os.stat(os.path.join(dirname, fileid))
+                source_files[fileid] = (stat.st_mtime, stat.st_size)
+        return source_files
+
+    @classmethod
+    def compile_file(cls, path):
+        """
+        Returns the template record for a single class file: the file's
+        mtime/size, the template version and, for each class (and subclass)
+        in it, its lemmas and compiled frame templates. The file is streamed
+        with iterparse and each frame is compiled (and freed) as soon as its
+        closing tag is read
+        """
+        stat = os.stat(path)
+        classes = []
+        class_stack = [] # [vn_class, lemmas, frames, frames seen] for each open (sub)class
+
+        for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+            if event == "start":
+                if elem.tag in ("VNCLASS", "VNSUBCLASS"):
+                    class_stack.append([elem.attrib["ID"], [], [], 0])
                 continue
 
-            for i, frame_xml in enumerate(frame_xmls):
+            if elem.tag == "MEMBER":
+                class_stack[-1][1].append(elem.attrib["name"])
+            elif elem.tag == "FRAME":
+                vn_class, lemmas, frames, frame_num = class_stack[-1]
+                # Frames are numbered by their index in the class, even if an
+                # earlier one was skipped, to match VerbNet
+                class_stack[-1][3] += 1
+                # Reset before parsing a frame so that we don't have huge numbers
+                VariableFactory.reset()
                 try:
-                    frame = Frame.fromxml(vn_class, frame_xml, i)
-                    frames.append(frame)
+                    frames.append(Frame.fromxml(vn_class, elem, frame_num).to_template())
                 except AttributeError:
-                    # This is (apparently) a rare bug in nltk's loader
-                    # Only happens with "slide"
-                    continue
+                    # Malformed frame (e.g. missing example), only happens with "slide"
+                    pass
+                elem.clear()
+            elif elem.tag in ("VNCLASS", "VNSUBCLASS"):
+                classes.append(class_stack.pop()[:3])
+
+        return {"mtime": stat.st_mtime, "size": stat.st_size, "version": cls.TEMPLATE_VERSION, "classes": classes}
+
+    @classmethod
+    def load_templates(cls, template_filename=DATA_DIR + 'verbnet_templates.json'):
+        """Returns the cached {fileid: template record} dict, or {} if not built yet"""
+        if not os.path.exists(template_filename):
+            return {}
+        with open(template_filename, 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def from_templates(cls, templates):
+        """
+        Returns VerbNet object built from compiled frame templates (see
+        compile_file) without touching any XML
+        """
+        class_to_frames = {}
+        lemma_to_classes = defaultdict(list)
+        frame_dict = {}
+        class_id_dict = {}
 
-                # Reset after parsing a frame so that we don't have huge numbers
-                VariableFactory.count_dict = defaultdict(int)
+        classes = [c for record in templates.values() for c in record["classes"]]
+        for vn_class, lemmas, frame_templates in sorted(classes, key=lambda c: c[0]):
+            frames = [Frame.from_template(vn_class, t) for t in frame_templates]
 
             # Store shorted vn_class b/c that's what propbank references
             shortened_vn_class = re.search(r"-([\d|\.|-]+)", vn_class).group(1)
             class_id_dict[shortened_vn_class] = vn_class
 
             class_to_frames[vn_class] = frames
-            lemmas = vnet.lemmas(vn_class)
             for lemma in lemmas:
                 lemma_to_classes[lemma].append(vn_class)
 
-        return VerbNet(lemma_to_classes, class_to_frames, frame_dict, class_id_dict)
+        return VerbNet(lemma_to_classes, class_to_frames, frame_dict, class_id_dict).build_class_index()
 
     @classmethod
-    def load(cls, xml_dirname=DATA_DIR + 'verbnet'):
+    def load(cls, xml_dirname=DATA_DIR + 'verbnet', xtag_mapper=None):
+        """
+        Returns VerbNet from cache if exists and was built from the current
+        class files, else from XML (only changed files are parsed again, see
+        fromxml). If an XTAGMapper is given, the lemma -> family -> frames
+        index is built for it (if the cached one is missing or out of date)
+        and stored in the cache too
+        """
         pickle_filename = DATA_DIR + 'verbnet.pickle'
+        source_files = cls.source_files(xml_dirname)
+        verbnet = None
         if os.path.exists(pickle_filename):
-            return pickle.load(open(pickle_filename, 'rb'))
-        else:
+            verbnet = pickle.load(open(pickle_filename, 'rb'))
+            changed = False
+            # Without the class files there's nothing to compare with, so the
+            # cache is used as is. getattr b/c older pickles don't record them
+            if source_files is not None and getattr(verbnet, 'source_files', None) != source_files:
+                verbnet = None
+        if verbnet is None:
             verbnet = cls.fromxml(xml_dirname)
+            changed = True
+
+        if xtag_mapper is not None and not verbnet.has_family_index(xtag_mapper):
+            verbnet.build_family_index(xtag_mapper)
+            changed = True
+
+        if changed:
             pickle.dump(verbnet, open(pickle_filename, 'wb'))
-            return verbnet
+        return verbnet
+
+class FrozenDict(dict):
+    """dict that can't be modified after creation"""
+
+    def immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict is immutable")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = immutable
+
+    def __reduce__(self):
+        # The default pickling fills the dict in with __setitem__
+        return (FrozenDict, (dict(self),))
 
 class Frame(object):
-    """Class representing a single verb frame in VerbNet"""
-    def __init__(self, vn_class, frame_num, primary, secondary, sem_dict, np_var_order, example):
+    """
+    Class representing a single verb frame in VerbNet. Frames can't be
+    modified after creation: sem_dict is a FrozenDict and np_var_order a
+    tuple. The Semantics and Variables in them are still shared by every
+    user of the frame, so they must be copied before being modified
+    """
+    def __init__(self, vn_class, frame_num, primary, secondary, sem_dict, np_var_order, example, lemma=None):
         self.vn_class = vn_class
         self.vn_class_id = vn_class.split("-")[-1]
         self.frame_num = frame_num
         self.primary = primary
         self.secondary = secondary
-        self.sem_dict = sem_dict
-        self.np_var_order = np_var_order
+        self.sem_dict = FrozenDict(sem_dict)
+        self.np_var_order = tuple(np_var_order)
         self.example = example
-        self.lemma = None
+        self.lemma = lemma
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        """
+        Frames are shared by every caller (and cached), so they can't be
+        modified after creation. Use lexicalize to get a modified copy
+        """
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Frame is immutable, cannot set '%s'" % name)
+        object.__setattr__(self, name, value)
+
+    def to_template(self):
+        """Returns a json-serializable representation of this frame (minus the class)"""
+        return {
+            "frame_num": self.frame_num,
+            "primary": self.primary,
+            "secondary": self.secondary,
+            "sem_dict": {k: sem.to_template() for k, sem in self.sem_dict.items()},
+            "np_var_order": [v.to_template() for v in self.np_var_order],
+            "example": self.example,
+        }
+
+    @classmethod
+    def from_template(cls, vn_class, template):
+        """Returns a Frame of vn_class from the output of to_template"""
+        sem_dict = {k: Semantics.from_template(t) for k, t in template["sem_dict"].items()}
+        np_var_order = [Variable.from_template(t) for t in template["np_var_order"]]
+        return Frame(vn_class, template["frame_num"], template["primary"], template["secondary"],
+            sem_dict, np_var_order, template["example"])
 
     def lexicalize(self, lemma):
-        """Returns self after adding any semantics that are specific to the lemma"""
-        self.lemma = lemma
-        titleized = lemma[0].upper() + lemma[1:]
-        self.sem_dict["Event"].apply_binding({'__ANCHOR__': titleized})
-        return self
+        """
+        Returns a new Frame after adding any semantics that are specific to the
+        lemma (the __ANCHOR__ placeholder becomes the uppercased lemma). The
+        semantics are deep copied, so self keeps its placeholder
+        """
+        anchor_rename = VariableBinding({Constant("__ANCHOR__"): Constant(lemma.upper())})
+        sem_dict = {k: copy.deepcopy(sem).apply_binding(anchor_rename) for k, sem in self.sem_dict.items()}
+        np_var_order = [v.copy() for v in self.np_var_order]
+        return Frame(self.vn_class, self.frame_num, self.primary, self.secondary,
+            sem_dict, np_var_order, self.example, lemma=lemma)
 
     @classmethod
     def fromxml(cls, vn_class, xml, frame_num):